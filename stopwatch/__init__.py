@@ -1,4 +1,7 @@
-from stopwatch import Timer, Counter, MetricLogger, PrintMetricLogger, LoggingMetricLogger
+from stopwatch import Timer, Counter, Gauge, MetricLogger, PrintMetricLogger, LoggingMetricLogger, \
+    AggregatingMetricLogger, ThreadLocalAggregatingMetricLogger, AsyncFileMetricLogger, BinaryMetricLogger, \
+    ShardedFileMetricLogger, SocketMetricLogger, CompactFileMetricLogger, BlockFileMetricLogger, \
+    AdaptiveSamplingMetricLogger, LiveStatsMetricLogger, QuantileSketch, timed, span, counted, settings
 
 # Set default logging handler to avoid "No handler found" warnings.
 import logging
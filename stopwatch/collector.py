@@ -0,0 +1,128 @@
+"""
+Collects events sent by SocketMetricLogger from any number of processes, aggregates them in memory and writes one
+rollup line per tag and interval, on the same format as AggregatingMetricLogger, so the log parser reads the output
+like any other log.
+
+    python stopwatch/collector.py --unix /tmp/stopwatch.sock my-metrics.log
+    python stopwatch/collector.py --udp 127.0.0.1:8126 my-metrics.log
+"""
+import sys, os, errno, socket, select, struct, signal, argparse
+from stopwatch import BinaryFormat, AggregatingMetricLogger, AsyncFileMetricLogger, timer_formatter, \
+    counter_formatter, timer_rollup_formatter, gauge_formatter
+
+# Record type code -> formatter of the events sent as that record type
+formatters = dict((formatter.RECORD_TYPE, formatter) for formatter in
+                  [timer_formatter, counter_formatter, timer_rollup_formatter, gauge_formatter])
+
+
+class Collector(object):
+    """
+    Listens on a Unix datagram socket if address is a path, or UDP if it is a (host, port) tuple, and logs the
+    received events to an AggregatingMetricLogger wrapping logger. Packets that can not be decoded are counted in
+    errors, after logging any events decoded before the error. The socket is served by a select loop in the calling
+    thread, see serve_forever() and poll().
+    """
+
+    # Larger than any datagram
+    MAX_PACKET_SIZE = 65536
+    # Requested socket receive buffer, which lets bursts queue up while rollups are written
+    RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, address, logger, interval=10, clock=None):
+        self.unix = isinstance(address, basestring)
+        self.socket = socket.socket(socket.AF_UNIX if self.unix else socket.AF_INET, socket.SOCK_DGRAM)
+        if self.unix and os.path.exists(address):
+            # Left behind by a collector that did not shut down cleanly
+            os.unlink(address)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.logger = AggregatingMetricLogger(logger, interval, clock)
+        self.errors = 0
+        self.closed = False
+
+    def serve_forever(self):
+        while not self.closed:
+            self.poll(self.logger.interval)
+
+    def poll(self, timeout):
+        """
+        Reads all pending packets, waiting at most timeout seconds for the first one, and writes the rollups if the
+        interval has passed.
+        """
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if readable:
+            self._receive()
+        logger = self.logger
+        if logger.clock() - logger.window_start >= logger.interval:
+            logger.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.logger.flush()
+        self.socket.close()
+        if self.unix:
+            os.unlink(self.address)
+
+    def _receive(self):
+        while True:
+            try:
+                packet = self.socket.recv(self.MAX_PACKET_SIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            try:
+                self._log(packet)
+            except (KeyError, IndexError, struct.error):
+                self.errors += 1
+
+    def _log(self, packet):
+        records, logger = BinaryFormat.records, self.logger
+        size = len(packet)
+        offset = 0
+        while offset < size:
+            record_type = packet[offset]
+            record, _ = records[record_type]
+            values = record.unpack_from(packet, offset)
+            tag_start = offset + record.size
+            offset = tag_start + values[1]
+            if offset > size:
+                raise IndexError('Truncated tag at offset {}'.format(tag_start))
+            logger.log(formatters[record_type], values[2], packet[tag_start:offset], *values[3:])
+
+
+parser = argparse.ArgumentParser(description='Collects metrics sent by SocketMetricLogger and writes rollups to file.')
+address_group = parser.add_mutually_exclusive_group(required=True)
+address_group.add_argument('--unix', help='path of the Unix datagram socket to listen on')
+address_group.add_argument('--udp', help='host:port to listen on, e.g. 127.0.0.1:8126')
+parser.add_argument('-i', '--interval', help='seconds between rollups', type=float, default=10)
+parser.add_argument('file', help='file to append rollup lines to')
+
+
+def parse_address(args):
+    if args.unix:
+        return args.unix
+    host, port = args.udp.rsplit(':', 1)
+    return host, int(port)
+
+
+def _exit(signum, frame):
+    sys.exit()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    file_logger = AsyncFileMetricLogger(args.file)
+    collector = Collector(parse_address(args), file_logger, args.interval)
+    signal.signal(signal.SIGTERM, _exit)
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+        file_logger.close()
@@ -1,16 +1,14 @@
 """
 
-    metrics: median, 80, 90, 95, 99
-
     --output (pretty, csv, json)
 
     -a --aggregate 5s 10m 1h 1d
 
 
 """
-import sys, argparse
+import sys, os, re, time, argparse, mmap, multiprocessing, cPickle, json, gzip, zlib, glob, heapq, copy, fractions
 from datetime import datetime
-from stopwatch import LogFormatter
+from stopwatch import LogFormatter, BinaryFormat, CompactFormat, BlockFormat, QuantileSketch, span
 
 
 class LogParser(object):
@@ -21,10 +19,20 @@ class LogParser(object):
         'tag': lambda stat: stat.tag,
         'count': lambda stat: stat.event_count,
         'total': lambda stat: stat.total_time if hasattr(stat, 'total_time') else 0,
-        'avg': lambda stat: stat.average if hasattr(stat, 'average') else 0
+        'avg': lambda stat: stat.average if hasattr(stat, 'average') else 0,
+        'median': lambda stat: stat.percentile(50) if hasattr(stat, 'percentile') else 0,
+        'p80': lambda stat: stat.percentile(80) if hasattr(stat, 'percentile') else 0,
+        'p90': lambda stat: stat.percentile(90) if hasattr(stat, 'percentile') else 0,
+        'p95': lambda stat: stat.percentile(95) if hasattr(stat, 'percentile') else 0,
+        'p99': lambda stat: stat.percentile(99) if hasattr(stat, 'percentile') else 0
     }
 
-    def __init__(self, in_file, verbose=True, sort_by='tag', reverse=False, interval=TEN_YEARS_IN_SECONDS):
+    # Binary search for a time stamp stops when the searched range is smaller than this
+    SEARCH_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, in_file, verbose=True, sort_by='tag', reverse=False, interval=TEN_YEARS_IN_SECONDS, jobs=1,
+                 time_from=None, time_to=None, slack=60, tag_filter=None, index_resolution=None, max_tags=None,
+                 output='pretty'):
         self.in_file = in_file
         self.verbose = verbose
         self.sort_by = sort_by
@@ -32,13 +40,242 @@ class LogParser(object):
         self.interval = interval
         if not self.interval:
             self.interval = self.TEN_YEARS_IN_SECONDS
+        self.jobs = jobs
+        self.time_from = time_from
+        self.time_to = time_to
+        self.slack = slack
+        self.tag_filter = tag_filter
+        self.index_resolution = index_resolution
+        self.max_tags = max_tags
+        self.output = output
 
     def parse(self):
-        with open(self.in_file) as file:
-            return self._parse_lines(file)
+        if not isinstance(self.in_file, basestring):
+            return self.parse_files(self.in_file)
+        if os.path.isdir(self.in_file):
+            return self.parse_files(shard_files(self.in_file))
+        if self.in_file.endswith('.gz'):
+            return self.parse_files([self.in_file])
+        if (self.index_resolution and self.time_from is None and self.time_to is None and
+                self.interval % self.index_resolution == 0):
+            return self._parse_indexed()
+
+        with open(self.in_file, 'rb') as file:
+            head = file.read(len(BinaryFormat.MAGIC))
+            if head == BinaryFormat.MAGIC:
+                return self._parse_records(file)
+            if head == BlockFormat.MAGIC:
+                return self._parse_blocks(file)
+            file.seek(0)
+            # Compact logs are split and searched at base lines, which start self-contained segments
+            compact = head.startswith(CompactFormat.BASE_START)
+            if self.time_from is not None or self.time_to is not None:
+                return self._parse_time_range(file, compact)
+            if self.jobs > 1:
+                return self._parse_parallel(file, compact)
+            origin = self._filtered_origin(file, compact)
+            file.seek(0)
+            return self._parse_text(file, self._new_stats(origin), compact)
+
+    def parse_intervals(self, intervals):
+        """
+        Parses the file once, in the greatest common divisor of intervals, and returns the stats rolled up to each of
+        the intervals.
+        """
+        parser = copy.copy(self)
+        parser.interval = reduce(fractions.gcd, intervals)
+        return self.rollups(parser.parse(), intervals)
+
+    @staticmethod
+    def rollups(aggregate_stats, intervals):
+        return [aggregate_stats if interval == aggregate_stats.interval else aggregate_stats.rollup(interval)
+                for interval in intervals]
+
+    def _parse_indexed(self):
+        """
+        Derives the stats from a sidecar index of stats at index resolution, which is rebuilt if the file has changed
+        since the index was written.
+        """
+        index_file_name = self.in_file + RollupIndex.SUFFIX
+        file_stat = os.stat(self.in_file)
+        index = RollupIndex.load(index_file_name)
+        if index is None or not index.matches(file_stat) or index.aggregate_stats.interval != self.index_resolution:
+            parser = LogParser(self.in_file, verbose=self.verbose, interval=self.index_resolution, jobs=self.jobs)
+            index = RollupIndex(file_stat.st_size, file_stat.st_mtime, parser.parse())
+            try:
+                index.save(index_file_name)
+            except (IOError, OSError) as e:
+                # E.g. a read-only directory. The stats are reported without an index.
+                if self.verbose:
+                    sys.stderr.write('Could not write index {}: {}'.format(index_file_name, e))
+
+        # Tags are filtered before the rollup, so that filtered out tags are not counted against max_tags
+        if self.tag_filter is not None:
+            self._filter_tags(index.aggregate_stats)
+        return index.aggregate_stats.rollup(self.interval, self.max_tags)
+
+    def _filter_tags(self, aggregate_stats):
+        for index, bucket in aggregate_stats.bucket_index.items():
+            for key, tag_stats in bucket.stats.items():
+                if not self.tag_filter.matches(tag_stats.tag):
+                    del bucket.stats[key]
+                    bucket.errors.pop(key, None)
+            if not bucket.stats:
+                del aggregate_stats.bucket_index[index]
+
+    def parse_files(self, file_names):
+        """
+        Parses several logs, e.g. a set of rotated and gzip compressed logs, merged in time stamp order. Files are
+        read as streams, so only one event per file is held in memory.
+        """
+        aggregate_stats = self._new_stats()
+        for event in heapq.merge(*[self._read_events(file_name) for file_name in file_names]):
+            aggregate_stats.add(*event)
+        return aggregate_stats
+
+    def _read_events(self, file_name):
+        compressed = file_name.endswith('.gz')
+        with (gzip.open if compressed else open)(file_name, 'rb') as file:
+            head = file.read(len(BinaryFormat.MAGIC))
+            if head == BlockFormat.MAGIC:
+                if compressed:
+                    raise ValueError('Compressed block logs are not supported: ' + file_name)
+                for event in self._line_events(self._read_block_lines(file, self._read_block_index(file)), file_name):
+                    yield event
+                return
+
+            if head == BinaryFormat.MAGIC:
+                if compressed:
+                    raise ValueError('Compressed binary logs are not supported: ' + file_name)
+                buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for event in self._read_records(buf):
+                        yield event
+                finally:
+                    buf.close()
+                return
+
+            file.seek(0)
+            if file.read(len(CompactFormat.BASE_START)) == CompactFormat.BASE_START:
+                file.seek(0)
+                for event in self._decode_compact(file, CompactDecoder()):
+                    yield event
+                return
+
+            file.seek(0)
+            for event in self._line_events(file, file_name):
+                yield event
+
+    def _line_events(self, lines, file_name):
+        line_count = 1
+        tag_filter = self.tag_filter
+        for line in lines:
+            if tag_filter is not None and not tag_filter.matches_line(line):
+                line_count += 1
+                continue
+            line = line.strip()
+            if self.is_stopwatch_line(line):
+                try:
+                    tokens = line.split(LogFormatter.TOKEN_SEPARATOR)
+                    metric_type = tokens[-2]
+                    if metric_type not in Bucket.aggregate_stats_classes:
+                        raise ValueError('Unknown metric type: ' + metric_type)
+                    event = (float(tokens[1]), tokens[2], metric_type, tokens[3:-2])
+                except:
+                    if self.verbose:
+                        e = sys.exc_info()[0]
+                        sys.stderr.write('Error reading line {} of {} {}: {}'.format(line_count, file_name, line, e))
+                else:
+                    yield event
+            line_count += 1
+
+    def parse_from(self, checkpoint=None):
+        """
+        Parses the lines appended to the file since checkpoint was taken and returns an updated checkpoint. If the
+        file has been rotated, the rest of the rotated file is parsed first if it can still be found next to the file.
+        """
+        file_stat = os.stat(self.in_file)
+        if checkpoint is None:
+            checkpoint = Checkpoint(file_stat.st_dev, file_stat.st_ino, 0, self._new_stats())
+        elif checkpoint.aggregate_stats.interval != self.interval:
+            raise ValueError('Checkpoint interval ' + str(checkpoint.aggregate_stats.interval) +
+                             ' does not match interval ' + str(self.interval))
+
+        if not checkpoint.matches(file_stat):
+            rotated_file = self._find_rotated(checkpoint)
+            if rotated_file:
+                self._parse_appended(rotated_file, checkpoint)
+            checkpoint.device, checkpoint.inode, checkpoint.offset = file_stat.st_dev, file_stat.st_ino, 0
+        elif file_stat.st_size < checkpoint.offset:
+            # Truncated, e.g. by copytruncate rotation
+            checkpoint.offset = 0
+
+        self._parse_appended(self.in_file, checkpoint)
+        return checkpoint
+
+    def _parse_appended(self, file_name, checkpoint):
+        with open(file_name, 'rb') as file:
+            head = file.read(len(BinaryFormat.MAGIC))
+            if head == BinaryFormat.MAGIC:
+                raise ValueError('Incremental parsing is only supported for text logs')
+            if head == BlockFormat.MAGIC:
+                # Only complete blocks are parsed, so a block being written is parsed on the next call
+                blocks = self._read_block_index(file, checkpoint.offset)
+                self._parse_lines(self._read_block_lines(file, blocks), checkpoint.aggregate_stats)
+                if blocks:
+                    checkpoint.offset = blocks[-1][0] + blocks[-1][1]
+                return
+            if checkpoint.offset == 0:
+                checkpoint.decoder = CompactDecoder() if head.startswith(CompactFormat.BASE_START) else None
+            file.seek(checkpoint.offset)
+            lines = self._read_complete_lines(file, checkpoint)
+            if checkpoint.decoder is not None:
+                self._parse_compact(lines, checkpoint.decoder, checkpoint.aggregate_stats)
+            else:
+                self._parse_lines(lines, checkpoint.aggregate_stats)
+
+    @staticmethod
+    def _read_complete_lines(log_file, checkpoint):
+        # Stops at a trailing partial line, which is parsed once the rest of it has been written
+        for line in iter(log_file.readline, ''):
+            if not line.endswith('\n'):
+                break
+            checkpoint.offset += len(line)
+            yield line
+
+    def _find_rotated(self, checkpoint):
+        directory = os.path.dirname(os.path.abspath(self.in_file))
+        prefix = os.path.basename(self.in_file)
+        for file_name in os.listdir(directory):
+            if not file_name.startswith(prefix):
+                continue
+            path = os.path.join(directory, file_name)
+            try:
+                if checkpoint.matches(os.stat(path)):
+                    return path
+            except OSError:
+                pass
+        return None
+
+    def parse_range(self, start, end, origin):
+        """
+        Parses the lines starting within [start, end) of the file, with buckets aligned to origin.
+        """
+        aggregate_stats = self._new_stats(origin)
+        with open(self.in_file, 'rb') as file:
+            compact = file.read(len(CompactFormat.BASE_START)) == CompactFormat.BASE_START
+            file.seek(start)
+            return self._parse_text(self._read_range(file, start, end), aggregate_stats, compact)
+
+    def parse_blocks(self, blocks, origin):
+        """
+        Parses blocks of a compressed log, as returned by _read_block_index, with buckets aligned to origin.
+        """
+        with open(self.in_file, 'rb') as file:
+            return self._parse_lines(self._read_block_lines(file, blocks), self._new_stats(origin))
 
     def print_stats(self, aggregate_stats):
-        output = PrintOutput(aggregate_stats)
+        output = outputs[self.output](aggregate_stats)
 
         for bucket in aggregate_stats.buckets:
             output.bucket_header(bucket)
@@ -46,11 +283,184 @@ class LogParser(object):
                 stat.visit(output)
             output.bucket_footer(bucket)
 
-    def _parse_lines(self, log_file):
-        aggregate_stats = AggregateStats(self.interval)
+    def _parse_time_range(self, log_file, compact=False):
+        """
+        Only reads the part of the file within the time range, assuming that lines are in time stamp order give or
+        take slack seconds. The start is found by binary search over file offsets, and reading stops at the first
+        line more than slack seconds after the end of the range. Compact logs are searched by their base lines.
+        """
+        origin = self._filtered_origin(log_file, compact)
+        log_file.seek(0)
+        start = 0
+        if self.time_from is not None:
+            start = self._find_offset(log_file, self.time_from - self.slack)
+            if compact:
+                start = self._next_base(log_file, start)
+        end_time_stamp = None
+        if self.time_to is not None:
+            end_time_stamp = self.time_to + self.slack
+
+        size = os.fstat(log_file.fileno()).st_size
+        lines = self._read_until(self._read_range(log_file, start, size), end_time_stamp)
+        return self._parse_text(lines, self._new_stats(origin), compact)
+
+    def _parse_text(self, lines, aggregate_stats, compact):
+        if compact:
+            return self._parse_compact(lines, CompactDecoder(), aggregate_stats)
+        return self._parse_lines(lines, aggregate_stats)
+
+    @staticmethod
+    def _next_base(log_file, offset):
+        # Returns the offset of the first base line of a compact log starting at or after offset, or the file size
+        log_file.seek(max(offset - 1, 0))
+        if offset > 0 and log_file.read(1) != '\n':
+            log_file.readline()
+        position = log_file.tell()
+        for line in iter(log_file.readline, ''):
+            if line.startswith(CompactFormat.BASE_START):
+                break
+            position += len(line)
+        return position
+
+    def _find_offset(self, log_file, time_stamp):
+        # Returns an offset before the first line with a time stamp >= time_stamp
+        low, high = 0, os.fstat(log_file.fileno()).st_size
+        while high - low > self.SEARCH_BLOCK_SIZE:
+            middle = (low + high) // 2
+            middle_time_stamp = self._next_time_stamp(log_file, middle)
+            if middle_time_stamp is None or middle_time_stamp >= time_stamp:
+                high = middle
+            else:
+                low = middle
+        return low
+
+    def _next_time_stamp(self, log_file, offset):
+        log_file.seek(offset)
+        if offset > 0:
+            log_file.readline()
+        for line in iter(log_file.readline, ''):
+            time_stamp = self._time_stamp(line)
+            if time_stamp is not None:
+                return time_stamp
+        return None
+
+    def _read_until(self, lines, end_time_stamp):
+        for line in lines:
+            if end_time_stamp is not None:
+                time_stamp = self._time_stamp(line)
+                if time_stamp is not None and time_stamp >= end_time_stamp:
+                    return
+            yield line
+
+    @staticmethod
+    def _time_stamp(line):
+        # Time stamp of a regular line, or of a base line of a compact log
+        if line.startswith(LogFormatter.START_TOKEN):
+            start = len(LogFormatter.START_TOKEN)
+        elif line.startswith(CompactFormat.BASE_START):
+            start = len(CompactFormat.BASE_START)
+        else:
+            return None
+        try:
+            return float(line[start:line.index(LogFormatter.TOKEN_SEPARATOR, start)])
+        except ValueError:
+            return None
+
+    def _new_stats(self, origin=None):
+        if origin is None:
+            origin = self.time_from
+        return AggregateStats(self.interval, origin, self.time_from, self.time_to, self.max_tags)
+
+    def _parse_parallel(self, log_file, compact=False):
+        origin = self._first_time_stamp(log_file, compact)
+        if origin is None:
+            return self._new_stats()
+
+        offsets = self._split_offsets(log_file, compact)
+        tasks = [(self.in_file, self.interval, self.verbose, self.time_from, self.time_to, self.tag_filter,
+                  self.max_tags, start, end, origin)
+                 for start, end in zip(offsets, offsets[1:]) if start < end]
+        return self._map(_parse_range, tasks, origin)
+
+    def _map(self, function, tasks, origin):
+        # Parses the tasks in a pool of jobs processes and merges the stats in task order
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            partial_stats = pool.map(function, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        aggregate_stats = self._new_stats(origin)
+        for stats in partial_stats:
+            aggregate_stats.merge(stats)
+        return aggregate_stats
+
+    def _filtered_origin(self, log_file, compact=False):
+        # Buckets are aligned to the first event of the file whatever its tag, as in a parallel or indexed parse, so
+        # that the tag filter does not move them
+        if self.tag_filter is None or self.time_from is not None:
+            return self.time_from
+        return self._first_time_stamp(log_file, compact)
+
+    def _unfiltered(self):
+        parser = copy.copy(self)
+        parser.tag_filter = None
+        return parser
+
+    def _first_time_stamp(self, log_file, compact=False):
+        # Time stamp of the first event, regardless of the tag filter
+        log_file.seek(0)
+        if compact:
+            for event in self._unfiltered()._decode_compact(log_file, CompactDecoder()):
+                return event[0]
+            return None
+        for line in log_file:
+            line = line.strip()
+            if self.is_stopwatch_line(line):
+                try:
+                    return float(line.split(LogFormatter.TOKEN_SEPARATOR)[1])
+                except ValueError:
+                    pass
+        return None
+
+    def _split_offsets(self, log_file, compact=False):
+        size = os.fstat(log_file.fileno()).st_size
+        offsets = [0]
+        for i in range(1, self.jobs):
+            offset = max(size * i / self.jobs, offsets[-1])
+            if compact:
+                offsets.append(self._next_base(log_file, offset))
+                continue
+            log_file.seek(offset)
+            if log_file.tell() > 0:
+                log_file.readline()
+            offsets.append(log_file.tell())
+        offsets.append(size)
+        return offsets
+
+    @staticmethod
+    def _read_range(log_file, start, end):
+        if start > 0:
+            # Only parse the line if it starts within the range, i.e. if the previous byte is a newline
+            log_file.seek(start - 1)
+            if log_file.read(1) != '\n':
+                start += len(log_file.readline())
+        position = start
+        while position < end:
+            line = log_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+    def _parse_lines(self, log_file, aggregate_stats):
         line_count = 1
+        tag_filter = self.tag_filter
         for line in log_file:
             try:
+                if tag_filter is not None and not tag_filter.matches_line(line):
+                    continue
                 self._parse_line(line, aggregate_stats)
             except:
                 if self.verbose:
@@ -61,6 +471,148 @@ class LogParser(object):
 
         return aggregate_stats
 
+    def _parse_compact(self, lines, decoder, aggregate_stats):
+        for event in self._decode_compact(lines, decoder):
+            aggregate_stats.add(*event)
+        return aggregate_stats
+
+    def _decode_compact(self, lines, decoder):
+        tag_filter = self.tag_filter
+        line_count = 1
+        for line in lines:
+            try:
+                event = decoder.decode(line.strip())
+                if event is not None and event[2] not in Bucket.aggregate_stats_classes:
+                    raise ValueError('Unknown metric type: ' + event[2])
+            except:
+                if self.verbose:
+                    e = sys.exc_info()[0]
+                    sys.stderr.write('Error reading line {} {}: {}'.format(line_count, line, e))
+            else:
+                if event is not None and (tag_filter is None or tag_filter.matches(event[1])):
+                    yield event
+            line_count += 1
+
+    def _parse_blocks(self, log_file):
+        """
+        Parses a compressed log, only decompressing the blocks that overlap the time range. With several jobs, the
+        blocks are split into runs of consecutive blocks, which are decompressed and parsed in parallel.
+        """
+        blocks = [block for block in self._read_block_index(log_file)
+                  if (self.time_from is None or block[4] >= self.time_from) and
+                  (self.time_to is None or block[3] < self.time_to)]
+        if not blocks:
+            return self._new_stats()
+        origin = self.time_from if self.time_from is not None else blocks[0][2]
+        if self.jobs <= 1 or len(blocks) == 1:
+            return self._parse_lines(self._read_block_lines(log_file, blocks), self._new_stats(origin))
+
+        run_length = -(-len(blocks) // self.jobs)
+        tasks = [(self.in_file, self.interval, self.verbose, self.time_from, self.time_to, self.tag_filter,
+                  self.max_tags, blocks[start:start + run_length], origin)
+                 for start in range(0, len(blocks), run_length)]
+        return self._map(_parse_block_run, tasks, origin)
+
+    def _read_block_index(self, log_file, offset=0):
+        """
+        Returns (data offset, length, first time stamp, min time stamp, max time stamp) of the complete blocks of a
+        compressed log from offset, read from the block headers. A trailing partial block, e.g. one being written, is
+        left out.
+        """
+        header = BlockFormat.HEADER
+        size = os.fstat(log_file.fileno()).st_size
+        blocks = []
+        while offset + header.size <= size:
+            log_file.seek(offset)
+            magic, length, first_time_stamp, min_time_stamp, max_time_stamp = header.unpack(log_file.read(header.size))
+            if magic != BlockFormat.MAGIC:
+                if self.verbose:
+                    sys.stderr.write('Invalid block header at offset {}'.format(offset))
+                break
+            offset += header.size
+            if offset + length > size:
+                break
+            blocks.append((offset, length, first_time_stamp, min_time_stamp, max_time_stamp))
+            offset += length
+        return blocks
+
+    def _read_block_lines(self, log_file, blocks):
+        for offset, length, _, _, _ in blocks:
+            log_file.seek(offset)
+            try:
+                lines = zlib.decompress(log_file.read(length)).splitlines()
+            except zlib.error:
+                if self.verbose:
+                    sys.stderr.write('Corrupt block at offset {}'.format(offset))
+                continue
+            for line in lines:
+                yield line
+
+    def _parse_records(self, log_file):
+        buf = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            origin = self.time_from
+            if self.tag_filter is not None and origin is None:
+                # Aligned to the first record whatever its tag, as for text logs
+                origin = next((event[0] for event in self._unfiltered()._read_records(buf)), None)
+            aggregate_stats = self._new_stats(origin)
+            for event in self._read_records(buf):
+                aggregate_stats.add(*event)
+        finally:
+            buf.close()
+
+        return aggregate_stats
+
+    def _read_records(self, buf):
+        magic, tag_type, tag_struct, records = (BinaryFormat.MAGIC, BinaryFormat.TAG_TYPE, BinaryFormat.TAG,
+                                                BinaryFormat.records)
+        size = len(buf)
+        offset = 0
+        tag_filter = self.tag_filter
+        # Tags by id, None for tags not matching the tag filter
+        tags = []
+        while offset < size:
+            record_type = buf[offset]
+            if record_type == magic[0]:
+                tags = []
+                offset += len(magic)
+                continue
+
+            if record_type == tag_type:
+                if offset + tag_struct.size > size:
+                    if self.verbose:
+                        sys.stderr.write('Truncated tag record at offset {}'.format(offset))
+                    break
+                _, tag_len = tag_struct.unpack_from(buf, offset)
+                if offset + tag_struct.size + tag_len > size:
+                    if self.verbose:
+                        sys.stderr.write('Truncated tag at offset {}'.format(offset))
+                    break
+                offset += tag_struct.size
+                tag = buf[offset:offset + tag_len]
+                tags.append(tag if tag_filter is None or tag_filter.matches(tag) else None)
+                offset += tag_len
+                continue
+
+            if record_type not in records:
+                if self.verbose:
+                    sys.stderr.write('Unknown record type {!r} at offset {}'.format(record_type, offset))
+                break
+            record, metric_type = records[record_type]
+            if offset + record.size > size:
+                if self.verbose:
+                    sys.stderr.write('Truncated record at offset {}'.format(offset))
+                break
+            values = record.unpack_from(buf, offset)
+            if values[1] >= len(tags):
+                if self.verbose:
+                    sys.stderr.write('Undefined tag id {} at offset {}'.format(values[1], offset))
+                break
+            offset += record.size
+            tag = tags[values[1]]
+            if tag is not None:
+                yield values[2], tag, metric_type, values[3:]
+
     def _parse_line(self, line, aggregate_stats):
         line = line.strip()
         if not self.is_stopwatch_line(line):
@@ -73,6 +625,50 @@ class LogParser(object):
         return line and line.startswith(LogFormatter.START_TOKEN) and line.endswith(LogFormatter.END_TOKEN)
 
 
+def _parse_range(task):
+    in_file, interval, verbose, time_from, time_to, tag_filter, max_tags, start, end, origin = task
+    parser = LogParser(in_file, verbose=verbose, interval=interval, time_from=time_from, time_to=time_to,
+                       tag_filter=tag_filter, max_tags=max_tags)
+    return parser.parse_range(start, end, origin)
+
+
+def _parse_block_run(task):
+    in_file, interval, verbose, time_from, time_to, tag_filter, max_tags, blocks, origin = task
+    parser = LogParser(in_file, verbose=verbose, interval=interval, time_from=time_from, time_to=time_to,
+                       tag_filter=tag_filter, max_tags=max_tags)
+    return parser.parse_blocks(blocks, origin)
+
+
+class TagFilter(object):
+    """
+    Matches tags exactly, by prefix or by a regular expression that must match from the start of the tag. Log lines
+    are matched on the raw line before it is split or converted, so non-matching lines are cheap to skip.
+    """
+
+    def __init__(self, tags=None, prefixes=None, regex=None):
+        self.tags = frozenset(tags or [])
+        self.prefixes = tuple(prefixes or [])
+        self.pattern = re.compile(regex) if regex else None
+        # A tag matches exactly if the line continues with a separator after it
+        self.line_prefixes = self.prefixes + tuple(tag + LogFormatter.TOKEN_SEPARATOR for tag in self.tags)
+
+    def matches(self, tag):
+        if tag in self.tags or tag.startswith(self.prefixes):
+            return True
+        return self.pattern is not None and self.pattern.match(tag) is not None
+
+    def matches_line(self, line):
+        separator = LogFormatter.TOKEN_SEPARATOR
+        tag_start = line.find(separator, line.find(separator) + 1) + 1
+        if line.startswith(self.line_prefixes, tag_start):
+            return True
+        if self.pattern is None:
+            return False
+        tag_end = line.find(separator, tag_start)
+        # Matched on the tag itself rather than from an offset into the line, where ^ would never match
+        return tag_end > 0 and self.pattern.match(line[tag_start:tag_end]) is not None
+
+
 class Output(object):
     def bucket_header(self, bucket):
         pass
@@ -86,17 +682,27 @@ class Output(object):
     def timer_stats(self, timer_stats):
         pass
 
+    def gauge_stats(self, gauge_stats):
+        pass
+
 
 class PrintOutput(Output):
+    PERCENTILES = [50, 80, 90, 95, 99]
+
     def __init__(self, aggregate_stats):
         self.tag_col_width = aggregate_stats.max_tag_len() + 4
         self.include_time = len(aggregate_stats.buckets) > 1
+        # Min, max and last columns are only shown in reports with gauges
+        self.include_gauges = any(stats.type == 'g' for bucket in aggregate_stats.bucket_index.itervalues()
+                                  for stats in bucket.stats.itervalues())
 
     def bucket_header(self, bucket):
         print ''
         self._print_time(bucket)
         tag_justified = 'Tag'.ljust(self.tag_col_width)
-        self._print_line(tag_justified, 'Type', 'Count', 'Total', 'Avg')
+        gauge_columns = ['Min', 'Max', 'Last'] if self.include_gauges else []
+        self._print_line(tag_justified, 'Type', 'Count', 'Total', 'Avg', 'Median', 'P80', 'P90', 'P95', 'P99',
+                         *gauge_columns)
 
     def _print_time(self, bucket):
         if not self.include_time:
@@ -108,21 +714,110 @@ class PrintOutput(Output):
         print start.strftime('%b-%m') + ': ' + start.strftime(time_format) + ' - ' + end.strftime(time_format)
 
     def counter_stats(self, counter_stats):
-        self._print_line(counter_stats.tag, 'count', str(counter_stats.event_count), '-', '-')
+        gauge_columns = ['-'] * 3 if self.include_gauges else []
+        self._print_line(counter_stats.tag, 'count', str(counter_stats.event_count), '-', '-',
+                         *['-'] * len(self.PERCENTILES) + gauge_columns)
 
     def timer_stats(self, timer_stats):
+        gauge_columns = []
+        if self.include_gauges:
+            gauge_columns = ['{:.3f}'.format(timer_stats.min_time), '{:.3f}'.format(timer_stats.max_time), '-']
         self._print_line(timer_stats.tag, 'time', str(timer_stats.event_count),
                          '{:.3f}'.format(timer_stats.total_time),
-                         '{:.3f}'.format(timer_stats.average))
+                         '{:.3f}'.format(timer_stats.average),
+                         *['{:.3f}'.format(timer_stats.percentile(p)) for p in self.PERCENTILES] + gauge_columns)
 
-    def _print_line(self, tag, type, event_count, total_time, average):
+    def gauge_stats(self, gauge_stats):
+        self._print_line(gauge_stats.tag, 'gauge', str(gauge_stats.event_count), '-',
+                         '{:.3f}'.format(gauge_stats.average),
+                         *['-'] * len(self.PERCENTILES) + ['{:.3f}'.format(gauge_stats.min_value),
+                                                           '{:.3f}'.format(gauge_stats.max_value),
+                                                           '{:.3f}'.format(gauge_stats.last)])
+
+    def _print_line(self, tag, *columns):
         tag_justified = tag.ljust(self.tag_col_width)
-        print "{}{:<10}    {:<10}    {:<10}    {:<10}".format(tag_justified, type, event_count, total_time, average)
+        print tag_justified + '    '.join('{:<10}'.format(column) for column in columns)
+
+    def bucket_footer(self, bucket):
+        print ''
+
+
+class SpanOutput(PrintOutput):
+    """
+    Prints the inclusive and exclusive time of every span path, see span_times. Counters and gauges are left out.
+    """
+
+    def bucket_header(self, bucket):
+        print ''
+        self._print_time(bucket)
+        self._print_line('Path'.ljust(self.tag_col_width), 'Count', 'Inclusive', 'Exclusive', 'Avg', 'Avg excl')
+        self.timers = []
+
+    def counter_stats(self, counter_stats):
+        pass
+
+    def timer_stats(self, timer_stats):
+        self.timers.append(timer_stats)
+
+    def gauge_stats(self, gauge_stats):
+        pass
 
     def bucket_footer(self, bucket):
+        # Printed in visiting order, i.e. in the sort order of the report
+        exclusive_times = dict((timer_stats.tag, exclusive_time) for timer_stats, exclusive_time in span_times(bucket))
+        for timer_stats in self.timers:
+            exclusive_time = exclusive_times.get(timer_stats.tag)
+            if exclusive_time is None:
+                continue
+            self._print_line(timer_stats.tag, str(timer_stats.event_count), '{:.3f}'.format(timer_stats.total_time),
+                             '{:.3f}'.format(exclusive_time), '{:.3f}'.format(timer_stats.average),
+                             '{:.3f}'.format(exclusive_time / timer_stats.event_count))
         print ''
 
 
+class CollapsedOutput(Output):
+    """
+    Prints the exclusive time of every span path in microseconds, on the collapsed stack format read by flame graph
+    tools, e.g. flamegraph.pl:
+
+        http.request;db.query 5230
+    """
+
+    def __init__(self, aggregate_stats):
+        pass
+
+    def bucket_footer(self, bucket):
+        for timer_stats, exclusive_time in span_times(bucket):
+            microseconds = int(round(exclusive_time * 1e6))
+            if microseconds > 0:
+                print timer_stats.tag + ' ' + str(microseconds)
+
+
+def span_times(bucket):
+    """
+    Returns (timer stats, exclusive time) for the timers of bucket, where the tag of a timer is read as a span path.
+    The exclusive time of a path is its total time less the total time of the paths one span below it, e.g. the
+    time of a;b less that of a;b;c, and is only accurate if a span and the spans below it end up in the same bucket.
+    """
+    timers = [stats for stats in bucket.stats.itervalues() if isinstance(stats, TimerStats) and
+              stats.tag != Bucket.OTHER_TAG]
+    child_times = {}
+    for stats in timers:
+        separator = stats.tag.rfind(span.SEPARATOR)
+        if separator >= 0:
+            parent = stats.tag[:separator]
+            child_times[parent] = child_times.get(parent, 0.0) + stats.total_time
+    return [(stats, max(stats.total_time - child_times.get(stats.tag, 0.0), 0.0))
+            for stats in sorted(timers, key=lambda stats: stats.tag)]
+
+
+outputs = {
+    'pretty': PrintOutput,
+    'spans': SpanOutput,
+    'collapsed': CollapsedOutput
+}
+
+
 class TimerStats(object):
     def __init__(self, type, tag):
         self.type = type
@@ -130,15 +825,47 @@ class TimerStats(object):
         self.event_count = 0
         self.total_time = 0.0
         self.average = 0.0
+        self.min_time = None
+        self.max_time = None
+        self.sketch = QuantileSketch()
         # Add rate, e.g. event_count per second
 
     def add(self, tokens):
         elapsed_time = float(tokens[0])
         event_count = int(tokens[1])
+        if len(tokens) > 2:
+            # Rollup line, carries min and max elapsed time of the rolled up events. The distribution within the
+            # rollup is unknown, so the sketch is approximated by counting all events at the rollup average.
+            min_time, max_time = float(tokens[2]), float(tokens[3])
+            self.sketch.add(elapsed_time / event_count, event_count)
+        else:
+            min_time = max_time = elapsed_time
+            self.sketch.add(elapsed_time, event_count)
 
         self.event_count += event_count
         self.total_time += elapsed_time
         self.average = self.total_time / self.event_count
+        self._add_min_max(min_time, max_time)
+
+    def merge(self, other):
+        if not other.event_count:
+            return
+        self.event_count += other.event_count
+        self.total_time += other.total_time
+        self.average = self.total_time / self.event_count
+        self._add_min_max(other.min_time, other.max_time)
+        self.sketch.merge(other.sketch)
+
+    def percentile(self, percentile):
+        if not self.event_count:
+            return 0.0
+        return min(max(self.sketch.quantile(percentile / 100.0), self.min_time), self.max_time)
+
+    def _add_min_max(self, min_time, max_time):
+        if self.min_time is None or min_time < self.min_time:
+            self.min_time = min_time
+        if self.max_time is None or max_time > self.max_time:
+            self.max_time = max_time
 
     def visit(self, visitor):
         visitor.timer_stats(self)
@@ -155,73 +882,415 @@ class CounterStats(object):
         event_count = int(tokens[0])
         self.event_count += event_count
 
+    def merge(self, other):
+        self.event_count += other.event_count
+
     def visit(self, visitor):
         visitor.counter_stats(self)
 
 
+class GaugeStats(object):
+    """
+    Last, min, max and average of a gauge. Lines must be added in time stamp order for last to be the latest value.
+    """
+
+    def __init__(self, type, tag):
+        self.type = type
+        self.tag = tag
+        self.event_count = 0
+        self.total = 0.0
+        self.average = 0.0
+        self.last = None
+        self.min_value = None
+        self.max_value = None
+
+    def add(self, tokens):
+        self._add(float(tokens[0]), float(tokens[1]), float(tokens[2]), float(tokens[3]), int(tokens[4]))
+
+    def merge(self, other):
+        if other.event_count:
+            self._add(other.last, other.min_value, other.max_value, other.total, other.event_count)
+
+    def _add(self, last, min_value, max_value, total, event_count):
+        self.last = last
+        if self.min_value is None or min_value < self.min_value:
+            self.min_value = min_value
+        if self.max_value is None or max_value > self.max_value:
+            self.max_value = max_value
+        self.total += total
+        self.event_count += event_count
+        self.average = self.total / self.event_count
+
+    def visit(self, visitor):
+        visitor.gauge_stats(self)
+
+
 class AggregateStats(object):
-    def __init__(self, interval):
+    """
+    Stats bucketed in fixed intervals. Buckets are keyed by their offset in intervals from origin, which defaults to
+    the first time stamp added, so lines can be added in any order. Lines outside [time_from, time_to) are ignored.
+    If max_tags is set, each bucket tracks at most max_tags tags, see Bucket.
+    """
+
+    def __init__(self, interval, origin=None, time_from=None, time_to=None, max_tags=None):
+        if max_tags is not None and max_tags < 1:
+            raise ValueError('max_tags must be at least 1, got ' + str(max_tags))
         self.interval = interval
-        self.buckets = []
+        self.origin = origin
+        self.time_from = time_from
+        self.time_to = time_to
+        self.max_tags = max_tags
+        self.bucket_index = {}
+
+    @property
+    def buckets(self):
+        return [self.bucket_index[index] for index in sorted(self.bucket_index)]
 
     def max_tag_len(self):
-        max_tag_len = 0
-        for bucket in self.buckets:
-            max_tag_len = max(max_tag_len, *(len(tag) for tag in bucket.stats.keys()))
-        return max_tag_len
+        return max([0] + [len(stats.tag) for bucket in self.bucket_index.itervalues()
+                          for stats in bucket.stats.itervalues()])
 
     def parse_line(self, line):
         tokens = line.split(LogFormatter.TOKEN_SEPARATOR)
-        time_stamp, tag, metric_type = float(tokens[1]), tokens[2], tokens[-2]
+        self.add(float(tokens[1]), tokens[2], tokens[-2], tokens[3:-2])
 
-        if not self.buckets:
-            self._new_bucket(time_stamp)
+    def add(self, time_stamp, tag, metric_type, values):
+        if self.time_from is not None and time_stamp < self.time_from:
+            return
+        if self.time_to is not None and time_stamp >= self.time_to:
+            return
+        if self.origin is None:
+            self.origin = time_stamp
+
+        index = int((time_stamp - self.origin) // self.interval)
+        bucket = self.bucket_index.get(index)
+        if bucket is None:
+            bucket = self._new_bucket(index)
 
-        current_bucket = self.buckets[-1]
-        if not current_bucket.fits(time_stamp):
-            current_bucket = self._new_bucket(time_stamp)
+        bucket.add(metric_type, tag, values)
 
-        remaining_tokens = tokens[3:-2]
-        current_bucket.add(metric_type, tag, remaining_tokens)
+    def merge(self, other):
+        if not other.bucket_index:
+            return
+        if self.origin is None:
+            self.origin = other.origin
+        elif other.origin != self.origin or other.interval != self.interval:
+            raise ValueError('Can not merge stats with different bucket origin or interval')
+
+        for index, other_bucket in other.bucket_index.iteritems():
+            bucket = self.bucket_index.get(index)
+            if bucket is None:
+                bucket = self._new_bucket(index)
+            bucket.merge(other_bucket)
+
+    def rollup(self, interval, max_tags=None):
+        """
+        Returns the stats in a coarser interval, which must be a multiple of this interval, by merging buckets. Tags
+        are capped at max_tags per bucket, which defaults to the cap of these stats.
+        """
+        if interval % self.interval:
+            raise ValueError('Interval ' + str(interval) + ' is not a multiple of ' + str(self.interval))
+        factor = int(round(interval / self.interval))
+
+        aggregate_stats = AggregateStats(interval, self.origin, self.time_from, self.time_to,
+                                         max_tags or self.max_tags)
+        # Buckets are merged in time order, so gauges keep their latest value
+        for index, bucket in sorted(self.bucket_index.iteritems()):
+            rollup_index = index // factor
+            rollup_bucket = aggregate_stats.bucket_index.get(rollup_index)
+            if rollup_bucket is None:
+                rollup_bucket = aggregate_stats._new_bucket(rollup_index)
+            rollup_bucket.merge(bucket)
+        return aggregate_stats
 
-    def _new_bucket(self, start_time):
-        end_time = start_time + self.interval
-        bucket = Bucket(start_time, end_time)
-        self.buckets.append(bucket)
+    def _new_bucket(self, index):
+        start_time = self.origin + index * self.interval
+        bucket = self.bucket_index[index] = Bucket(start_time, start_time + self.interval, self.max_tags)
         return bucket
 
 
 class Bucket(object):
+    """
+    Stats per tag within [start_time, end_time). If max_tags is set, at most max_tags tags are tracked using
+    Space-Saving: when a new tag arrives at the cap, the tracked tag with the lowest weight, its event count plus error,
+    is evicted and its stats folded into the OTHER_TAG row of its type. The new tag inherits the evicted weight as the
+    error of its event count, which bounds how many of its events may have been folded into OTHER_TAG. Tags with more
+    than the total event count divided by max_tags events are always tracked.
+    """
+    OTHER_TAG = '__other__'
+
     aggregate_stats_classes = {
         't': TimerStats,
-        'c': CounterStats
+        'c': CounterStats,
+        'g': GaugeStats
     }
 
-    def __init__(self, start_time, end_time):
+    def __init__(self, start_time, end_time, max_tags=None):
         self.start_time = start_time
         self.end_time = end_time
+        self.max_tags = max_tags
         self.stats = {}
+        # Error per tracked tag, and a heap of (weight, tag) lower bounds of the tracked tags' weights
+        self.errors = {}
+        self.heap = []
 
     def fits(self, time_stamp):
-        return time_stamp >= self.start_time and time_stamp <= self.end_time
+        return self.start_time <= time_stamp < self.end_time
 
     def add(self, type, tag, tokens):
-        if tag not in self.stats:
-            self.stats[tag] = self.aggregate_stats_classes[type](type, tag)
-
-        tag_stats = self.stats[tag]
+        tag_stats = self.stats.get(tag)
+        if tag_stats is None:
+            tag_stats = self._track(type, tag, 0)
         tag_stats.add(tokens)
 
+    def merge(self, other):
+        for key, other_stats in other.stats.iteritems():
+            tag_stats = self.stats.get(key)
+            error = other.errors.get(key, 0)
+            if tag_stats is None:
+                if other_stats.tag == self.OTHER_TAG:
+                    tag_stats = self._other(other_stats.type)
+                else:
+                    tag_stats = self._track(other_stats.type, other_stats.tag, error)
+            elif error and key in self.errors:
+                self.errors[key] += error
+            tag_stats.merge(other_stats)
+
+    def error(self, tag):
+        """
+        Returns the maximum number of events of tag that may have been counted in OTHER_TAG.
+        """
+        return self.errors.get(tag, 0)
+
+    def _track(self, type, tag, error):
+        if self.max_tags is not None:
+            if len(self.errors) >= self.max_tags:
+                error += self._evict()
+            self.errors[tag] = error
+            heapq.heappush(self.heap, (error, tag))
+            if len(self.heap) > 2 * self.max_tags:
+                self._compact()
+        tag_stats = self.stats[tag] = self.aggregate_stats_classes[type](type, tag)
+        return tag_stats
+
+    def _evict(self):
+        heap, errors = self.heap, self.errors
+        while True:
+            weight, tag = heap[0]
+            if tag not in errors:
+                # Left behind by an earlier eviction of the tag
+                heapq.heappop(heap)
+                continue
+            current_weight = self.stats[tag].event_count + errors[tag]
+            if current_weight > weight:
+                heapq.heapreplace(heap, (current_weight, tag))
+                continue
+
+            heapq.heappop(heap)
+            del errors[tag]
+            tag_stats = self.stats.pop(tag)
+            self._other(tag_stats.type).merge(tag_stats)
+            return current_weight
+
+    def _compact(self):
+        self.heap = [(self.stats[tag].event_count + error, tag) for tag, error in self.errors.iteritems()]
+        heapq.heapify(self.heap)
+
+    def _other(self, type):
+        # The separator can not be part of a tag, so the key never collides with a tag
+        key = self.OTHER_TAG + LogFormatter.TOKEN_SEPARATOR + type
+        other_stats = self.stats.get(key)
+        if other_stats is None:
+            other_stats = self.stats[key] = self.aggregate_stats_classes[type](type, self.OTHER_TAG)
+        return other_stats
+
+
+class CompactDecoder(object):
+    """
+    Decodes lines on the compact text format, see CompactFormat, keeping the tags and base time stamp of the lines
+    decoded so far. Regular lines are decoded as well.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.base = None
+
+    def decode(self, line):
+        """
+        Returns the event of an event line as (time stamp, tag, metric type, values), or None for other lines.
+        """
+        if line.startswith(CompactFormat.EVENT_START):
+            tokens = line.split(LogFormatter.TOKEN_SEPARATOR)
+            return self.base + float(tokens[1]), self.tags[tokens[2]], tokens[-2], tokens[3:-2]
+        if line.startswith(CompactFormat.TAG_START):
+            tokens = line.split(LogFormatter.TOKEN_SEPARATOR)
+            self.tags[tokens[1]] = tokens[2]
+        elif line.startswith(CompactFormat.BASE_START):
+            self.base = float(line.split(LogFormatter.TOKEN_SEPARATOR)[1])
+        elif LogParser.is_stopwatch_line(line):
+            tokens = line.split(LogFormatter.TOKEN_SEPARATOR)
+            return float(tokens[1]), tokens[2], tokens[-2], tokens[3:-2]
+        return None
+
+
+class Checkpoint(object):
+    """
+    Parse state of a growing log file: the file identity, the offset parsed up to and the stats parsed so far. For
+    compact logs, the decoder holds the tags and base time stamp read so far.
+    """
+
+    def __init__(self, device, inode, offset, aggregate_stats, decoder=None):
+        self.device = device
+        self.inode = inode
+        self.offset = offset
+        self.aggregate_stats = aggregate_stats
+        self.decoder = decoder
+
+    def matches(self, file_stat):
+        return file_stat.st_dev == self.device and file_stat.st_ino == self.inode
+
+    def save(self, file_name):
+        _save(cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL), file_name)
+
+    @staticmethod
+    def load(file_name):
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, 'rb') as file:
+            return cPickle.load(file)
+
+
+class RollupIndex(object):
+    """
+    Sidecar index of a log file, holding the stats of the file at a fine resolution together with the size and
+    modification time of the file when it was parsed. The index is stored as JSON, see _encode, rather than pickled,
+    as it is read from wherever the log is, e.g. a directory others can write to.
+    """
+    SUFFIX = '.swidx'
+
+    def __init__(self, size, mtime, aggregate_stats):
+        self.size = size
+        self.mtime = mtime
+        self.aggregate_stats = aggregate_stats
+
+    def matches(self, file_stat):
+        return file_stat.st_size == self.size and file_stat.st_mtime == self.mtime
+
+    def save(self, file_name):
+        # Tags are byte strings, which latin-1 maps to and from JSON strings one to one whatever their encoding
+        _save(json.dumps(_encode(self), encoding='latin-1'), file_name)
+
+    @staticmethod
+    def load(file_name):
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with open(file_name, 'rb') as file:
+                index = _decode(json.load(file))
+            if not isinstance(index, RollupIndex):
+                raise ValueError('Not an index: ' + file_name)
+            return index
+        except Exception:
+            # Unreadable, e.g. corrupt or written by another version. The index is rebuilt.
+            return None
+
+
+def _save(data, file_name):
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as file:
+        file.write(data)
+    os.rename(tmp_file_name, file_name)
+
+
+# Classes that may be stored in an index. Only these are created when an index is read, without calling any methods.
+index_classes = dict((cls.__name__, cls) for cls in [RollupIndex, AggregateStats, Bucket, TimerStats, CounterStats,
+                                                     GaugeStats, QuantileSketch])
+
+
+def _encode(value):
+    """
+    Returns value as JSON compatible data. Objects of index_classes are encoded as their class name and attributes,
+    and dicts and tuples are tagged, so that _decode restores non-string keys and the tuples of Bucket.heap.
+    """
+    if isinstance(value, dict):
+        return {'dict': [[_encode(key), _encode(item)] for key, item in value.iteritems()]}
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if index_classes.get(type(value).__name__) is type(value):
+        return {'class': type(value).__name__, 'attributes': _encode(value.__dict__)}
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    raise TypeError('Can not encode ' + repr(value))
+
+
+def _decode(data):
+    if isinstance(data, list):
+        return [_decode(item) for item in data]
+    if isinstance(data, unicode):
+        return data.encode('latin-1')
+    if not isinstance(data, dict):
+        return data
+    if 'dict' in data:
+        return dict((_decode(key), _decode(item)) for key, item in data['dict'])
+    if 'tuple' in data:
+        return tuple(_decode(item) for item in data['tuple'])
+    cls = index_classes[data['class']]
+    obj = cls.__new__(cls)
+    obj.__dict__.update(_decode(data['attributes']))
+    return obj
+
+
+def positive_int(str_value):
+    value = int(str_value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer: ' + str_value)
+    return value
+
 
 parser = argparse.ArgumentParser(description='Aggregates metrics from Stopwatch formatted file')
 parser.add_argument('-v', '--verbose', help='verbose logging', action='store_true', default=False)
-parser.add_argument('-s', '--sort', help='sort order', choices=['tag', 'count', 'total', 'avg'], default='tag')
+parser.add_argument('-s', '--sort', help='sort order',
+                    choices=['tag', 'count', 'total', 'avg', 'median', 'p80', 'p90', 'p95', 'p99'], default='tag')
 parser.add_argument('-r', '--reverse', help='reverse sort order', action='store_true', default=False)
 parser.add_argument('-a', '--aggregate', help='aggregate stats in specified intervals. Intervals should be specified '
                                               'on the format nx, where n is a positive integer and x is one of \'s\' '
-                                              '(seconds), \'m\' (minutes) or \'h\' (hours) ',
-                    default=None)
-parser.add_argument('file', help='file to parse')
+                                              '(seconds), \'m\' (minutes) or \'h\' (hours). Several intervals may '
+                                              'be given, comma separated or by repeating the option, and are all '
+                                              'reported from a single parse', action='append', default=None)
+parser.add_argument('-j', '--jobs', help='number of processes to parse the file with', type=int, default=1)
+parser.add_argument('--from', help='only include lines logged at or after this time. Times are specified as seconds '
+                                   'since the epoch, on the format YYYY-MM-DD HH:MM:SS (local time), or as an interval '
+                                   'before now, e.g. 15m', dest='time_from', default=None)
+parser.add_argument('--to', help='only include lines logged before this time', dest='time_to', default=None)
+parser.add_argument('--slack', help='seconds lines may be out of time stamp order when reading a time range',
+                    type=float, default=60)
+parser.add_argument('--tag', help='only include this tag. May be given several times', action='append', default=None)
+parser.add_argument('--tag-prefix', help='only include tags starting with this prefix. May be given several times',
+                    action='append', default=None)
+parser.add_argument('--tag-regex', help='only include tags matching this regular expression, matched from the start '
+                                        'of the tag', default=None)
+parser.add_argument('-i', '--index', help='write a sidecar index next to the file and report from it as long as the '
+                                        'file is unchanged', action='store_true', default=False)
+parser.add_argument('--index-resolution', help='interval of the stats in the index, on the same format as --aggregate. '
+                                               'Reports can be answered from the index for intervals that are '
+                                               'multiples of this', default='10s')
+parser.add_argument('--max-tags', help='maximum number of tags per interval. The most frequent tags are reported, '
+                                       'and the rest are counted in an __other__ row', type=positive_int, default=None)
+parser.add_argument('-o', '--output', help='report format. pretty reports stats per tag, spans inclusive and exclusive '
+                                         'time per span path, and collapsed exclusive time per span path on the '
+                                         'collapsed stack format of flame graph tools', choices=sorted(outputs),
+                    default='pretty')
+parser.add_argument('-c', '--checkpoint', help='checkpoint file. Only lines appended since the last run are parsed and '
+                                               'added to the stats stored in the checkpoint', default=None)
+parser.add_argument('-f', '--follow', help='keep parsing lines as they are appended to the file and print stats '
+                                           'every poll interval', action='store_true', default=False)
+parser.add_argument('--poll-interval', help='seconds between parses in follow mode', type=float, default=10)
+parser.add_argument('files', help='files to parse. Several files, e.g. rotated and gzip compressed logs, are merged '
+                                  'and reported as one log. Glob patterns are expanded, and directories are read as '
+                                  'the logs in them, e.g. the shards of a ShardedFileMetricLogger', nargs='+',
+                    metavar='file')
 
 
 def parse_interval(str_interval):
@@ -238,14 +1307,75 @@ def parse_interval(str_interval):
 
     return value * intervals[unit]
 
+
+def parse_time(str_time):
+    if not str_time:
+        return None
+
+    try:
+        return float(str_time)
+    except ValueError:
+        pass
+    for time_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(datetime.strptime(str_time, time_format).timetuple())
+        except ValueError:
+            pass
+    return time.time() - parse_interval(str_time)
+
+
+def shard_files(directory):
+    """
+    Returns the logs in directory, e.g. the per process files of a ShardedFileMetricLogger.
+    """
+    return sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                  if not file_name.startswith('.') and not file_name.endswith(RollupIndex.SUFFIX) and
+                  os.path.isfile(os.path.join(directory, file_name)))
+
+
+def expand_files(patterns):
+    file_names = []
+    for pattern in patterns:
+        for file_name in sorted(glob.glob(pattern)) or [pattern]:
+            file_names.extend(shard_files(file_name) if os.path.isdir(file_name) else [file_name])
+    return file_names
+
 if __name__ == "__main__":
     args = parser.parse_args()
 
-    file_name = args.file
+    file_names = expand_files(args.files)
+    file_name = file_names[0] if len(file_names) == 1 else file_names
+    if (args.checkpoint or args.follow) and (len(file_names) > 1 or file_name.endswith('.gz')):
+        parser.error('--checkpoint and --follow require a single uncompressed file')
 
-    log_interval = parse_interval(args.aggregate)
-    print 'Interval: ' + str(log_interval)
+    log_intervals = [parse_interval(value) for values in args.aggregate or [] for value in values.split(',')] or [None]
+    intervals = [log_interval or LogParser.TEN_YEARS_IN_SECONDS for log_interval in log_intervals]
+    tag_filter = None
+    if args.tag or args.tag_prefix or args.tag_regex:
+        tag_filter = TagFilter(args.tag, args.tag_prefix, args.tag_regex)
     parser = LogParser(file_name, verbose=args.verbose, sort_by=args.sort, reverse=args.reverse,
-                       interval=log_interval)
-    stats = parser.parse()
-    parser.print_stats(stats)
\ No newline at end of file
+                       interval=reduce(fractions.gcd, intervals), jobs=args.jobs, time_from=parse_time(args.time_from),
+                       time_to=parse_time(args.time_to), slack=args.slack, tag_filter=tag_filter,
+                       index_resolution=parse_interval(args.index_resolution) if args.index else None,
+                       max_tags=args.max_tags, output=args.output)
+
+    def print_views(views):
+        for log_interval, stats in zip(log_intervals, views):
+            # Collapsed stacks are piped to flame graph tools, which read every line as a stack
+            if args.output != 'collapsed':
+                print 'Interval: ' + str(log_interval)
+            parser.print_stats(stats)
+
+    if not args.checkpoint and not args.follow:
+        print_views(parser.parse_intervals(intervals))
+        sys.exit()
+
+    checkpoint = Checkpoint.load(args.checkpoint) if args.checkpoint else None
+    while True:
+        checkpoint = parser.parse_from(checkpoint)
+        if args.checkpoint:
+            checkpoint.save(args.checkpoint)
+        print_views(LogParser.rollups(checkpoint.aggregate_stats, intervals))
+        if not args.follow:
+            break
+        time.sleep(args.poll_interval)
\ No newline at end of file
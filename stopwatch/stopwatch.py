@@ -1,19 +1,31 @@
 from time import time
-import random, logging
+import os, random, logging, threading, atexit, Queue, struct, math, functools, socket, zlib
+
+try:  # Python 3.3+
+    from time import monotonic
+    # Maps monotonic clock readings to wall clock time stamps
+    MONOTONIC_OFFSET = time() - monotonic()
+except ImportError:
+    monotonic = time
+    MONOTONIC_OFFSET = 0
 
 LOG = logging.getLogger('stopwatch')
 
 
 class Timer(object):
+    __slots__ = ('start_time', 'logger', 'clock', 'time_offset', 'rand')
 
     def __init__(self, logger=None, clock=None):
         self.start_time = None
         self.logger = logger
         if not logger:
             self.logger = PrintMetricLogger()
+        # Elapsed time is measured on a monotonic clock, unless a clock is given
         self.clock = clock
+        self.time_offset = 0
         if not clock:
-            self.clock = time
+            self.clock = monotonic
+            self.time_offset = MONOTONIC_OFFSET
         self.rand = random.random
         self.start()
 
@@ -22,13 +34,17 @@ class Timer(object):
 
     def stop(self, tag, sample_rate=1, threshold=0):
         elapsed_time = self.clock() - self.start_time
+        if elapsed_time < threshold:
+            return elapsed_time
 
-        if sample_rate <= 0 or sample_rate < self.rand() or elapsed_time < threshold:
+        if sample_rate == 1:
+            event_count = 1
+        elif sample_rate <= 0 or sample_rate < self.rand():
             return elapsed_time
+        else:
+            event_count = int(round(1 / sample_rate))
 
-        event_count = int(round(1 / sample_rate))
-        self.logger.log(timer_formatter, time_stamp=self.start_time, tag=tag,
-                        elapsed_time=elapsed_time, event_count=event_count)
+        self.logger.log(timer_formatter, self.start_time + self.time_offset, tag, elapsed_time, event_count)
         return elapsed_time
 
     def lap(self, tag, sample_rate=1, threshold=0):
@@ -38,6 +54,8 @@ class Timer(object):
 
 
 class Counter(object):
+    __slots__ = ('logger', 'clock', 'rand')
+
     def __init__(self, logger=None, clock=None):
         self.logger = logger
         if not logger:
@@ -48,40 +66,142 @@ class Counter(object):
         self.rand = random.random
 
     def incr(self, tag, count=1, sample_rate=1):
-        if sample_rate > 0 and sample_rate >= self.rand():
+        if sample_rate == 1:
+            # Counts are logged as integers, like sampled counts, which is free for the common integer count
+            self.logger.log(counter_formatter, self.clock(), tag, count if type(count) is int else int(round(count)))
+        elif sample_rate > 0 and sample_rate >= self.rand():
             event_count = int(round(count / sample_rate))
-            self.logger.log(counter_formatter, time_stamp=self.clock(), tag=tag, event_count=event_count)
+            self.logger.log(counter_formatter, self.clock(), tag, event_count)
 
 
 class LogFormatter(object):
+    """
+    Formats a logged event as a line. Events are logged as a time stamp, a tag and the values named by FIELDS, in the
+    order they appear on the line.
+    """
     TOKEN_SEPARATOR = '|'
     START_TOKEN = '<' + TOKEN_SEPARATOR
     END_TOKEN = TOKEN_SEPARATOR + '>'
 
-    def format(self, **kwargs):
-        return self.FORMAT.format(**kwargs)
+    def format(self, time_stamp, tag, *values):
+        return self.FORMAT.format(time_stamp, tag, *values)
 
 
 class TimerFormatter(LogFormatter):
-    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{time_stamp}',
-                                                '{tag}',
-                                                '{elapsed_time:f}',
-                                                '{event_count}',
+    TYPE = 't'
+    RECORD_TYPE = 't'
+    FIELDS = ('elapsed_time', 'event_count')
+    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{0}',
+                                                '{1}',
+                                                '{2:f}',
+                                                '{3}',
                                                 't' + LogFormatter.END_TOKEN])
 
 
 class CounterFormatter(LogFormatter):
-    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{time_stamp}',
-                                                '{tag}',
-                                                '{event_count}',
+    TYPE = 'c'
+    RECORD_TYPE = 'c'
+    FIELDS = ('event_count',)
+    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{0}',
+                                                '{1}',
+                                                '{2}',
                                                 'c' + LogFormatter.END_TOKEN])
 
+
+class TimerRollupFormatter(LogFormatter):
+    TYPE = 't'
+    RECORD_TYPE = 'r'
+    FIELDS = ('elapsed_time', 'event_count', 'min_time', 'max_time')
+    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{0}',
+                                                '{1}',
+                                                '{2:f}',
+                                                '{3}',
+                                                '{4:f}',
+                                                '{5:f}',
+                                                't' + LogFormatter.END_TOKEN])
+
+
+class GaugeFormatter(LogFormatter):
+    TYPE = 'g'
+    RECORD_TYPE = 'g'
+    FIELDS = ('last', 'min_value', 'max_value', 'total', 'event_count')
+    FORMAT = LogFormatter.TOKEN_SEPARATOR.join([LogFormatter.START_TOKEN + '{0}',
+                                                '{1}',
+                                                '{2:f}',
+                                                '{3:f}',
+                                                '{4:f}',
+                                                '{5:f}',
+                                                '{6}',
+                                                'g' + LogFormatter.END_TOKEN])
+
 timer_formatter = TimerFormatter()
 counter_formatter = CounterFormatter()
+timer_rollup_formatter = TimerRollupFormatter()
+gauge_formatter = GaugeFormatter()
+
+
+class BinaryFormat(object):
+    """
+    Binary log format. A file is a sequence of segments, each starting with MAGIC. Within a segment, every tag is
+    defined once by a TAG record followed by the encoded tag, and later referenced by its id, i.e. the order in which
+    it was defined. All other records are fixed width, keyed by their first byte.
+    """
+    MAGIC = 'SWB1'
+    TAG_TYPE = 'D'
+    TAG = struct.Struct('<cH')
+    TIMER = struct.Struct('<cIddq')
+    COUNTER = struct.Struct('<cIdq')
+    TIMER_ROLLUP = struct.Struct('<cIddqdd')
+    GAUGE = struct.Struct('<cIdddddq')
+
+    # Record type code, see LogFormatter.RECORD_TYPE -> (record struct, metric type)
+    records = {
+        't': (TIMER, 't'),
+        'c': (COUNTER, 'c'),
+        'r': (TIMER_ROLLUP, 't'),
+        'g': (GAUGE, 'g')
+    }
+
+    @staticmethod
+    def encode_tag(tag):
+        """Returns the tag as bytes. Unicode tags are encoded as UTF-8, byte string tags are written as is."""
+        return tag.encode('utf-8') if isinstance(tag, unicode) else tag
+
+
+class CompactFormat(object):
+    """
+    Compact text log format. A segment starts with a BASE line holding a time stamp. Every tag is defined once per
+    segment by a TAG line mapping a numeric id to the tag, and EVENT lines are regular lines with the time stamp
+    relative to the base, in milliseconds precision, and the tag id in place of the tag. As segments do not depend on
+    the lines before them, a reader can start at any BASE line, e.g. to parse a file in parallel or from a time:
+
+        <@|1400000000.0|>
+        <#|0|my.tag|>
+        <+|0.123|0|0.001234|1|t|>
+    """
+    BASE_START = '<@' + LogFormatter.TOKEN_SEPARATOR
+    TAG_START = '<#' + LogFormatter.TOKEN_SEPARATOR
+    EVENT_START = '<+' + LogFormatter.TOKEN_SEPARATOR
+
+    @staticmethod
+    def event_format(formatter):
+        return CompactFormat.EVENT_START + formatter.FORMAT[len(LogFormatter.START_TOKEN):]
+
+
+class BlockFormat(object):
+    """
+    Compressed log format. A file is a sequence of blocks, each a HEADER followed by length bytes of zlib compressed
+    regular text lines. The header holds the first, least and greatest time stamp of the lines in the block, so the
+    headers double as an index: a reader can skip blocks outside a time range, or hand blocks to several processes,
+    by seeking from header to header without decompressing anything.
+    """
+    MAGIC = 'SWZ1'
+    # Magic, compressed length, first time stamp, min time stamp, max time stamp
+    HEADER = struct.Struct('<4sIddd')
 
 
 class MetricLogger(object):
-    def log(self, formatter, **kwargs):
+    def log(self, formatter, time_stamp, tag, *values):
         raise NotImplementedError()
 
 
@@ -90,8 +210,8 @@ class PrintMetricLogger(MetricLogger):
     def __init__(self):
         pass
 
-    def log(self, formatter, **kwargs):
-        print formatter.format(kwargs)
+    def log(self, formatter, time_stamp, tag, *values):
+        print formatter.format(time_stamp, tag, *values)
 
 
 class LoggingMetricLogger(MetricLogger):
@@ -99,7 +219,1116 @@ class LoggingMetricLogger(MetricLogger):
     def __init__(self, logger):
         self.logger = logger
 
-    def log(self, formatter, **kwargs):
+    def log(self, formatter, time_stamp, tag, *values):
         if self.logger.isEnabledFor(logging.INFO):
-            self.logger.info(formatter.format(**kwargs))
+            self.logger.info(formatter.format(time_stamp, tag, *values))
+
+
+class Settings(object):
+    """
+    Global settings for timed and counted. When enabled is False, they only check this flag before running the
+    timed block or function. Unless a logger is given to them, they log to logger, or print if it is not set.
+    """
+    __slots__ = ('enabled', 'logger')
+
+    def __init__(self):
+        self.enabled = True
+        self.logger = None
+
+settings = Settings()
+
+
+class DefaultMetricLogger(MetricLogger):
+    def __init__(self):
+        self.print_logger = PrintMetricLogger()
+
+    def log(self, formatter, time_stamp, tag, *values):
+        (settings.logger or self.print_logger).log(formatter, time_stamp, tag, *values)
+
+default_logger = DefaultMetricLogger()
+
+
+class timed(object):
+    """
+    Times a block when used as a context manager, or every call when used as a function decorator, and logs the
+    elapsed time under tag like Timer.stop. Sampling is decided before the clock is read, so events that are not
+    logged cost next to nothing. Use a new instance for every with statement.
+    """
+    __slots__ = ('tag', 'logger', 'sample_rate', 'threshold', 'event_count', 'clock', 'time_offset', 'rand',
+                 'start_time')
+
+    def __init__(self, tag, logger=None, sample_rate=1, threshold=0, clock=None):
+        self.tag = tag
+        self.logger = logger or default_logger
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.event_count = int(round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.clock = clock
+        self.time_offset = 0
+        if not clock:
+            self.clock = monotonic
+            self.time_offset = MONOTONIC_OFFSET
+        self.rand = random.random
+        self.start_time = None
+
+    def __enter__(self):
+        if settings.enabled and self._sampled():
+            self.start_time = self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_time is not None:
+            self._log(self.start_time)
+            self.start_time = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.enabled or not self._sampled():
+                return func(*args, **kwargs)
+            start_time = self.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._log(start_time)
+        return wrapper
+
+    def _sampled(self):
+        sample_rate = self.sample_rate
+        return sample_rate == 1 or 0 < sample_rate and sample_rate >= self.rand()
+
+    def _log(self, start_time):
+        elapsed_time = self.clock() - start_time
+        if elapsed_time >= self.threshold:
+            self.logger.log(timer_formatter, start_time + self.time_offset, self.tag, elapsed_time, self.event_count)
+
+
+# Path of the innermost open span of each thread, see span
+_spans = threading.local()
+
+
+class span(object):
+    """
+    Times a block when used as a context manager, or every call when used as a function decorator, like timed, but
+    logs the elapsed time under the path of the span: the tags of the enclosing spans of the same thread followed by
+    its own tag, separated by SEPARATOR, e.g. http.request;db.query. The log parser reports inclusive and exclusive
+    time per path, see its --output option. Tags must not contain SEPARATOR. Use a new instance for every with
+    statement.
+    """
+    SEPARATOR = ';'
+
+    __slots__ = ('tag', 'logger', 'clock', 'time_offset', 'parent_path', 'start_time')
+
+    def __init__(self, tag, logger=None, clock=None):
+        self.tag = tag
+        self.logger = logger or default_logger
+        self.clock = clock
+        self.time_offset = 0
+        if not clock:
+            self.clock = monotonic
+            self.time_offset = MONOTONIC_OFFSET
+        self.parent_path = None
+        self.start_time = None
+
+    @staticmethod
+    def current_path():
+        """
+        Returns the path of the innermost open span of the calling thread, or None outside of spans.
+        """
+        return getattr(_spans, 'path', None)
+
+    def __enter__(self):
+        if settings.enabled:
+            self.parent_path = getattr(_spans, 'path', None)
+            _spans.path = self._path(self.parent_path)
+            self.start_time = self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_time is not None:
+            path = _spans.path
+            _spans.path = self.parent_path
+            self._log(path, self.start_time)
+            self.start_time = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.enabled:
+                return func(*args, **kwargs)
+            parent_path = getattr(_spans, 'path', None)
+            path = _spans.path = self._path(parent_path)
+            start_time = self.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _spans.path = parent_path
+                self._log(path, start_time)
+        return wrapper
+
+    def _path(self, parent_path):
+        return self.tag if parent_path is None else parent_path + self.SEPARATOR + self.tag
+
+    def _log(self, path, start_time):
+        self.logger.log(timer_formatter, start_time + self.time_offset, path, self.clock() - start_time, 1)
+
+
+class counted(object):
+    """
+    Function decorator that counts every call under tag like Counter.incr.
+    """
+
+    def __init__(self, tag, count=1, logger=None, sample_rate=1, clock=None):
+        self.tag = tag
+        self.count = count
+        self.sample_rate = sample_rate
+        self.counter = Counter(logger or default_logger, clock)
+
+    def __call__(self, func):
+        incr, tag, count, sample_rate = self.counter.incr, self.tag, self.count, self.sample_rate
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if settings.enabled:
+                incr(tag, count, sample_rate)
+            return func(*args, **kwargs)
+        return wrapper
+
+
+class QuantileSketch(object):
+    """
+    Log bucketed histogram for approximate quantiles. Bin bounds grow by a constant factor, so estimated quantiles are
+    within relative_accuracy of the true value and memory is bounded by max_bins regardless of the number of values.
+    Sketches with the same relative accuracy merge exactly.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        self.count += count
+        if value <= self.min_value:
+            self.zero_count += count
+            return
+
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        if index in self.bins:
+            self.bins[index] += count
+        else:
+            self.bins[index] = count
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('Can not merge sketches with different relative accuracy')
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self._collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def _collapse(self):
+        # Folds the lowest bins into each other, trading accuracy of the lowest quantiles for bounded memory
+        if len(self.bins) <= self.max_bins:
+            return
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+
+class TimerRollup(object):
+    formatter = timer_rollup_formatter
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.event_count = 0
+        self.elapsed_time = 0.0
+        self.min_time = None
+        self.max_time = None
+
+    def add(self, elapsed_time, event_count, min_time=None, max_time=None):
+        # Rollups logged by another aggregating logger carry their own min and max
+        if min_time is None:
+            min_time = max_time = elapsed_time
+        self.event_count += event_count
+        self.elapsed_time += elapsed_time
+        if self.min_time is None or min_time < self.min_time:
+            self.min_time = min_time
+        if self.max_time is None or max_time > self.max_time:
+            self.max_time = max_time
+
+    def merge(self, other):
+        self.event_count += other.event_count
+        self.elapsed_time += other.elapsed_time
+        if self.min_time is None or other.min_time < self.min_time:
+            self.min_time = other.min_time
+        if self.max_time is None or other.max_time > self.max_time:
+            self.max_time = other.max_time
+
+    def values(self):
+        return self.elapsed_time, self.event_count, self.min_time, self.max_time
+
+
+class CounterRollup(object):
+    formatter = counter_formatter
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.event_count = 0
+
+    def add(self, event_count):
+        self.event_count += event_count
+
+    def merge(self, other):
+        self.event_count += other.event_count
+
+    def values(self):
+        return self.event_count,
+
+
+class GaugeRollup(object):
+    formatter = gauge_formatter
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.last = None
+        self.min_value = None
+        self.max_value = None
+        self.total = 0.0
+        self.event_count = 0
+
+    def add(self, last, min_value, max_value, total, event_count):
+        self.last = last
+        if self.min_value is None or min_value < self.min_value:
+            self.min_value = min_value
+        if self.max_value is None or max_value > self.max_value:
+            self.max_value = max_value
+        self.total += total
+        self.event_count += event_count
+
+    def merge(self, other):
+        self.add(*other.values())
+
+    def values(self):
+        return self.last, self.min_value, self.max_value, self.total, self.event_count
+
+
+class AggregatingMetricLogger(MetricLogger):
+    """
+    Keeps per tag rollups in memory and writes one line per tag and interval to the wrapped logger.
+    Rollups are flushed by the first event logged after the interval has passed, or by calling flush(), which is also
+    called at interpreter exit.
+    """
+    rollup_classes = {
+        't': TimerRollup,
+        'c': CounterRollup,
+        'g': GaugeRollup
+    }
+
+    def __init__(self, logger=None, interval=10, clock=None):
+        self.logger = logger
+        if not logger:
+            self.logger = PrintMetricLogger()
+        self.interval = interval
+        self.clock = clock
+        if not clock:
+            self.clock = time
+        self.lock = threading.Lock()
+        self.rollups = {}
+        self.window_start = self.clock()
+        # Registered after the wrapped logger, so the last rollups are written before it is closed
+        atexit.register(self.flush)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        key = (formatter.TYPE, tag)
+        with self.lock:
+            # The interval is checked first, so an event after an idle period starts a new window instead of being
+            # written with the time stamp of the old one
+            window = self._swap() if self.clock() - self.window_start >= self.interval else None
+            rollup = self.rollups.get(key)
+            if rollup is None:
+                rollup = self.rollups[key] = self.rollup_classes[formatter.TYPE](tag)
+            rollup.add(*values)
+
+        if window is not None:
+            self._write(*window)
+
+    def flush(self):
+        with self.lock:
+            window_start, rollups = self._swap()
+
+        self._write(window_start, rollups)
+
+    def _swap(self):
+        window_start, rollups = self.window_start, self.rollups
+        self.window_start = self.clock()
+        self.rollups = {}
+        return window_start, rollups
+
+    def _write(self, window_start, rollups):
+        for rollup in rollups.itervalues():
+            self.logger.log(rollup.formatter, window_start, rollup.tag, *rollup.values())
+
+
+class ThreadLocalAggregatingMetricLogger(AggregatingMetricLogger):
+    """
+    Like AggregatingMetricLogger, but every thread adds to rollups of its own, guarded by a lock that is only contended
+    while flushing. Flushing merges the rollups of all threads, including threads that have exited since the last
+    flush, and writes one line per tag.
+    """
+
+    def __init__(self, logger=None, interval=10, clock=None):
+        AggregatingMetricLogger.__init__(self, logger, interval, clock)
+        self.local = threading.local()
+        self.slots = []
+
+    def log(self, formatter, time_stamp, tag, *values):
+        try:
+            slot = self.local.slot
+        except AttributeError:
+            slot = self._new_slot()
+        # The interval is checked before the event is added, so an event after an idle period starts a new window
+        window = None
+        if self.clock() - self.window_start >= self.interval:
+            window = self._swap_if_passed()
+        key = (formatter.TYPE, tag)
+        with slot.lock:
+            rollup = slot.rollups.get(key)
+            if rollup is None:
+                rollup = slot.rollups[key] = self.rollup_classes[formatter.TYPE](tag)
+            rollup.add(*values)
+
+        if window is not None:
+            self._write(*window)
+
+    def _swap_if_passed(self):
+        # Threads that find the interval passed while another thread is flushing it leave it to that thread
+        if not self.lock.acquire(False):
+            return None
+        try:
+            if self.clock() - self.window_start < self.interval:
+                return None
+            return self._swap()
+        finally:
+            self.lock.release()
+
+    def _new_slot(self):
+        slot = self.local.slot = _ThreadSlot()
+        with self.lock:
+            self.slots.append(slot)
+        return slot
+
+    def _swap(self):
+        window_start = self.window_start
+        self.window_start = self.clock()
+        rollups = {}
+        for slot in list(self.slots):
+            # A thread that is not alive before its rollups are taken can not add any more
+            alive = slot.thread.is_alive()
+            with slot.lock:
+                slot_rollups, slot.rollups = slot.rollups, {}
+            if not alive:
+                self.slots.remove(slot)
+            for key, slot_rollup in slot_rollups.iteritems():
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollups[key] = slot_rollup
+                else:
+                    rollup.merge(slot_rollup)
+        return window_start, rollups
+
+
+class _ThreadSlot(object):
+    __slots__ = ('thread', 'lock', 'rollups')
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+        self.rollups = {}
+
+
+class AdaptiveSamplingMetricLogger(MetricLogger):
+    """
+    Samples timer and counter events so that at most lines_per_second lines are written per tag, or over all tags if
+    per_tag is False. Each tag keeps every k-th event on average, where k is recalculated every window seconds from the
+    event rate of the tag in the last window. Over all tags, the budget is shared so that tags below their fair share
+    keep every event and only the hottest tags are sampled.
+
+    A sampled event stands for k events. Counter events are logged with k times the count, and timer events as rollup
+    lines with k times the event count and k times the elapsed time, which the log parser totals the same way as
+    unsampled timer lines, so counts, totals and averages in the report stay unbiased.
+    """
+
+    def __init__(self, logger=None, lines_per_second=100, per_tag=True, window=1, clock=None):
+        self.logger = logger
+        if not logger:
+            self.logger = PrintMetricLogger()
+        self.lines_per_window = lines_per_second * window
+        self.per_tag = per_tag
+        self.window = window
+        self.clock = clock
+        if not clock:
+            self.clock = time
+        self.rand = random.random
+        self.lock = threading.Lock()
+        # Events per tag in the current window, and the sampling factor k per tag
+        self.event_counts = {}
+        self.factors = {}
+        self.window_start = self.clock()
+
+    def log(self, formatter, time_stamp, tag, *values):
+        record_type = formatter.RECORD_TYPE
+        if record_type != 't' and record_type != 'c':
+            self.logger.log(formatter, time_stamp, tag, *values)
+            return
+
+        if self.clock() - self.window_start >= self.window:
+            self._adapt()
+        event_counts = self.event_counts
+        event_counts[tag] = event_counts.get(tag, 0) + 1
+
+        factor = self.factors.get(tag, 1)
+        if factor == 1:
+            self.logger.log(formatter, time_stamp, tag, *values)
+        elif self.rand() * factor < 1:
+            if record_type == 'c':
+                self.logger.log(formatter, time_stamp, tag, values[0] * factor)
+            else:
+                elapsed_time, event_count = values
+                # A timer line counts its elapsed time once whatever its event count, see TimerStats.add
+                self.logger.log(timer_rollup_formatter, time_stamp, tag, elapsed_time * factor, event_count * factor,
+                                elapsed_time, elapsed_time)
+
+    def _adapt(self):
+        # Threads that find the window passed while another thread is adapting keep the current factors
+        if not self.lock.acquire(False):
+            return
+        try:
+            now = self.clock()
+            if now - self.window_start < self.window:
+                return
+            event_counts, self.event_counts = self.event_counts, {}
+            # Scale counts to a full window if the window was overrun, e.g. after an idle period
+            scale = float(self.window) / (now - self.window_start)
+            self.window_start = now
+
+            limit = self._fair_share(event_counts.values(), scale) if not self.per_tag else self.lines_per_window
+            factors = {}
+            for tag, event_count in event_counts.iteritems():
+                factor = int(math.ceil(event_count * scale / limit)) if limit else 1
+                if factor > 1:
+                    factors[tag] = factor
+            self.factors = factors
+        finally:
+            self.lock.release()
+
+    def _fair_share(self, event_counts, scale):
+        """
+        Returns the per tag limit that fits all tags within the budget, each tag getting at most the limit, or None if
+        all tags fit without sampling.
+        """
+        remaining = self.lines_per_window
+        event_counts = sorted(event_counts)
+        for index, event_count in enumerate(event_counts):
+            share = float(remaining) / (len(event_counts) - index)
+            if event_count * scale > share:
+                return share
+            remaining -= event_count * scale
+        return None
+
+
+class LiveStatsMetricLogger(MetricLogger):
+    """
+    Keeps a ring of per second buckets for each tag, so that the count, rate, average and approximate quantiles of a
+    tag over the last seconds can be queried from within the process, see stats(). Queries merge at most window
+    buckets. Tags with no events in the last window seconds are dropped. Events are also passed on to logger, if set.
+
+    Timer events add their elapsed time, rollups their average, and gauges the average of their values to the
+    quantiles. Sampled timer events count event_count times.
+    """
+
+    def __init__(self, logger=None, window=60, clock=None, relative_accuracy=0.01, max_bins=256):
+        self.logger = logger
+        self.window = int(window)
+        self.clock = clock
+        if not clock:
+            self.clock = time
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.lock = threading.Lock()
+        self.rings = {}
+        self.last_prune = int(self.clock())
+
+    def log(self, formatter, time_stamp, tag, *values):
+        record_type = formatter.RECORD_TYPE
+        if record_type == 't':
+            elapsed_time, event_count = values
+            value, total = elapsed_time, elapsed_time * event_count
+        elif record_type == 'c':
+            event_count, = values
+            value = total = None
+        elif record_type == 'r':
+            total, event_count = values[:2]
+            value = total / event_count
+        else:
+            total, event_count = values[3:]
+            value = total / event_count
+
+        second = int(self.clock())
+        with self.lock:
+            ring = self.rings.get(tag)
+            if ring is None:
+                ring = self.rings[tag] = _LiveRing(self.window)
+            bucket = ring.bucket(second)
+            bucket.event_count += event_count
+            if value is not None:
+                bucket.total += total
+                if bucket.sketch is None:
+                    bucket.sketch = QuantileSketch(self.relative_accuracy, max_bins=self.max_bins)
+                bucket.sketch.add(value, event_count)
+            if second - self.last_prune >= self.window:
+                self._prune(second)
+
+        if self.logger is not None:
+            self.logger.log(formatter, time_stamp, tag, *values)
+
+    def tags(self):
+        with self.lock:
+            return self.rings.keys()
+
+    def stats(self, tag, seconds=None):
+        """
+        Returns the stats of tag over the last seconds, including the current second, up to and defaulting to window.
+        """
+        seconds = min(int(seconds or self.window), self.window)
+        now = int(self.clock())
+        live_stats = LiveStats(tag, seconds, QuantileSketch(self.relative_accuracy, max_bins=self.max_bins))
+        with self.lock:
+            ring = self.rings.get(tag)
+            if ring is None:
+                return live_stats
+            for bucket in ring.buckets:
+                if now - seconds < bucket.second <= now:
+                    live_stats.event_count += bucket.event_count
+                    live_stats.total += bucket.total
+                    if bucket.sketch is not None:
+                        live_stats.sketch.merge(bucket.sketch)
+        return live_stats
+
+    def _prune(self, second):
+        self.last_prune = second
+        for tag, ring in self.rings.items():
+            if ring.latest <= second - self.window:
+                del self.rings[tag]
+
+
+class LiveStats(object):
+    """
+    Stats of a tag over the last seconds, see LiveStatsMetricLogger.stats().
+    """
+
+    def __init__(self, tag, seconds, sketch):
+        self.tag = tag
+        self.seconds = seconds
+        self.event_count = 0
+        self.total = 0.0
+        self.sketch = sketch
+
+    @property
+    def rate(self):
+        return float(self.event_count) / self.seconds
+
+    @property
+    def average(self):
+        # Counters have no values to average
+        if not self.sketch.count:
+            return 0.0
+        return self.total / self.sketch.count
+
+    def percentile(self, percentile):
+        return self.sketch.quantile(percentile / 100.0)
+
+
+class _LiveRing(object):
+    __slots__ = ('buckets', 'latest')
+
+    def __init__(self, size):
+        self.buckets = [_LiveBucket() for _ in range(size)]
+        self.latest = None
+
+    def bucket(self, second):
+        bucket = self.buckets[second % len(self.buckets)]
+        if bucket.second != second:
+            bucket.second = second
+            bucket.event_count = 0
+            bucket.total = 0.0
+            bucket.sketch = None
+        if self.latest is None or second > self.latest:
+            self.latest = second
+        return bucket
+
+
+class _LiveBucket(object):
+    __slots__ = ('second', 'event_count', 'total', 'sketch')
+
+    def __init__(self):
+        self.second = None
+        self.event_count = 0
+        self.total = 0.0
+        self.sketch = None
+
+
+class Gauge(object):
+    """
+    Records the current value of e.g. a queue depth or the resident memory. Values set within an interval are
+    coalesced in memory and logged as one line per tag with the last, min, max, sum and count of the values. Pending
+    values are logged on flush(), which is also called at interpreter exit.
+    """
+
+    def __init__(self, logger=None, interval=10, clock=None):
+        self.logger = AggregatingMetricLogger(logger, interval, clock)
+
+    def set(self, tag, value):
+        # The aggregating logger time stamps lines with the start of the interval
+        self.logger.log(gauge_formatter, None, tag, value, value, value, value, 1)
+
+    def flush(self):
+        self.logger.flush()
+
+
+class AsyncFileMetricLogger(MetricLogger):
+    """
+    Queues logged events and formats and writes them to file in batches from a background thread.
+    When the queue is full, events are either dropped and counted in dropped, or the caller blocks.
+    Events that can not be formatted or written are counted in errors, and the writer carries on.
+    Pending events are written on close(), which is also called at interpreter exit. Events logged after the writer
+    has stopped are counted in dropped.
+    """
+    DROP = 'drop'
+    BLOCK = 'block'
+
+    # Seconds between checks that the writer is still alive while waiting on the queue or for a flush
+    FLUSH_POLL_INTERVAL = 0.1
+
+    _FLUSH = object()
+    _CLOSE = object()
+
+    def __init__(self, file_name, max_queue_size=100000, overflow=DROP, batch_size=1000):
+        if overflow not in (self.DROP, self.BLOCK):
+            raise ValueError('Unknown overflow policy: ' + str(overflow) + '. Expected one of ' +
+                             str([self.DROP, self.BLOCK]))
+        self.file_name = file_name
+        # Opened here rather than in the writer, so that a bad path fails in the caller
+        self.file = open(file_name, 'a')
+        self.batch_size = batch_size
+        self.block = overflow == self.BLOCK
+        self.queue = Queue.Queue(max_queue_size)
+        self.dropped = 0
+        self.errors = 0
+        self.closed = False
+        self.drop_lock = threading.Lock()
+        self.close_lock = threading.Lock()
+        self.writer = threading.Thread(target=self._write_loop, name='stopwatch-writer')
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        if self.closed:
+            return
+        if self.block:
+            queued = self._put((formatter, time_stamp, tag, values))
+        else:
+            try:
+                self.queue.put_nowait((formatter, time_stamp, tag, values))
+                queued = True
+            except Queue.Full:
+                queued = False
+        if not queued:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def flush(self):
+        if self.closed:
+            return
+        done = threading.Event()
+        if not self._put((self._FLUSH, done, None, None)):
+            return
+        # The writer may exit before reaching the flush, e.g. if the logger is closed concurrently
+        while not done.wait(self.FLUSH_POLL_INTERVAL):
+            if not self.writer.is_alive():
+                return
+
+    def close(self):
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self._put((self._CLOSE, None, None, None)):
+            self.writer.join()
+
+    def _put(self, item):
+        """Queues an item, waiting for room as long as the writer is alive. Returns whether the item was queued."""
+        while self.writer.is_alive():
+            try:
+                self.queue.put(item, True, self.FLUSH_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _write_loop(self):
+        with self.file as out_file:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                lines = []
+                for formatter, time_stamp, tag, values in batch:
+                    if formatter is self._FLUSH or formatter is self._CLOSE:
+                        self._write(out_file, lines)
+                        lines = []
+                        if formatter is self._CLOSE:
+                            return
+                        # The flush event is passed in place of the time stamp
+                        time_stamp.set()
+                    else:
+                        try:
+                            lines.append(formatter.format(time_stamp, tag, *values))
+                        except Exception:
+                            self.errors += 1
+                self._write(out_file, lines)
+
+    def _write(self, out_file, lines):
+        if lines:
+            try:
+                out_file.write('\n'.join(lines) + '\n')
+                out_file.flush()
+            except (IOError, OSError):
+                self.errors += len(lines)
+
+
+class BinaryMetricLogger(MetricLogger):
+    """
+    Writes events to file on the binary log format. Every logger instance starts a new segment in the file.
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'ab')
+        self.file.write(BinaryFormat.MAGIC)
+        self.tag_ids = {}
+        self.closed = False
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        record, _ = BinaryFormat.records[formatter.RECORD_TYPE]
+        with self.lock:
+            if self.closed:
+                return
+            tag_id = self.tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self.tag_ids[tag] = len(self.tag_ids)
+                encoded_tag = BinaryFormat.encode_tag(tag)
+                self.file.write(BinaryFormat.TAG.pack(BinaryFormat.TAG_TYPE, len(encoded_tag)) + encoded_tag)
+
+            self.file.write(record.pack(formatter.RECORD_TYPE, tag_id, time_stamp, *values))
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.file.close()
+
+
+class SocketMetricLogger(MetricLogger):
+    """
+    Sends events to a collector, see collector.py, over a Unix datagram socket if address is a path, or UDP if it is a
+    (host, port) tuple. Events are encoded as binary records, see BinaryFormat, with the length of the tag in place of
+    the tag id followed by the tag, and sent in datagrams of up to max_packet_size bytes, or when flush_interval seconds
+    have passed since the last datagram. The socket never blocks; events that can not be sent, e.g. because the
+    collector is down or can not keep up, are counted in dropped. Pending events are sent on close(), which is also
+    called at interpreter exit.
+    """
+
+    def __init__(self, address, max_packet_size=8192, flush_interval=1.0):
+        self.address = address
+        family = socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.max_packet_size = max_packet_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.records = []
+        self.packet_size = 0
+        self.event_count = 0
+        self.last_send = time()
+        self.closed = False
+        atexit.register(self.close)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        record, _ = BinaryFormat.records[formatter.RECORD_TYPE]
+        encoded_tag = BinaryFormat.encode_tag(tag)
+        packed = record.pack(formatter.RECORD_TYPE, len(encoded_tag), time_stamp, *values) + encoded_tag
+        with self.lock:
+            if self.closed:
+                return
+            if self.packet_size + len(packed) > self.max_packet_size:
+                self._send()
+            self.records.append(packed)
+            self.packet_size += len(packed)
+            self.event_count += 1
+            if time() - self.last_send >= self.flush_interval:
+                self._send()
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self._send()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self._send()
+                self.closed = True
+                self.socket.close()
+
+    def _send(self):
+        if self.records:
+            try:
+                self.socket.sendto(''.join(self.records), self.address)
+            except socket.error:
+                self.dropped += self.event_count
+            self.records = []
+            self.packet_size = 0
+            self.event_count = 0
+        self.last_send = time()
+
+
+class CompactFileMetricLogger(MetricLogger):
+    """
+    Writes events to file on the compact text format, see CompactFormat. A new segment is started every base_interval
+    seconds, and the file is reopened if it has been rotated, which is checked whenever a segment is started. Only one
+    logger may write to a file at a time. Buffered lines are written on flush() and close(), which is also
+    called at interpreter exit.
+    """
+
+    def __init__(self, file_name, base_interval=60):
+        self.file_name = file_name
+        self.base_interval = base_interval
+        self.event_formats = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self._open()
+        atexit.register(self.close)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        with self.lock:
+            if self.closed:
+                return
+            if self.base is None or time_stamp - self.base >= self.base_interval:
+                self._move_base(time_stamp)
+            tag_id = self.tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self.tag_ids[tag] = len(self.tag_ids)
+                self.file.write(CompactFormat.TAG_START + str(tag_id) + LogFormatter.TOKEN_SEPARATOR + tag +
+                                LogFormatter.END_TOKEN + '\n')
+
+            event_format = self.event_formats.get(formatter)
+            if event_format is None:
+                event_format = self.event_formats[formatter] = CompactFormat.event_format(formatter)
+            self.file.write(event_format.format('{:.3f}'.format(time_stamp - self.base), tag_id, *values) + '\n')
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.file.close()
+
+    def _open(self):
+        self.file = open(self.file_name, 'a')
+        self.base = None
+
+    def _move_base(self, time_stamp):
+        if self.base is not None and self._rotated():
+            self.file.close()
+            self._open()
+        self.base = time_stamp
+        self.tag_ids = {}
+        self.file.write(CompactFormat.BASE_START + repr(time_stamp) + LogFormatter.END_TOKEN + '\n')
+
+    def _rotated(self):
+        try:
+            return os.stat(self.file_name).st_ino != os.fstat(self.file.fileno()).st_ino
+        except OSError:
+            return True
+
+
+class BlockFileMetricLogger(MetricLogger):
+    """
+    Writes events to file on the compressed log format, see BlockFormat. Lines are buffered and written as a block
+    when block_size bytes of lines have been buffered, or when flush_interval seconds have passed since the last block.
+    Each block is written with a single append, and the file is reopened if it has been rotated. Buffered lines are
+    written on flush() and close(), which is also called at interpreter exit.
+    """
+
+    def __init__(self, file_name, block_size=256 * 1024, flush_interval=10.0, level=6):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.level = level
+        self.lock = threading.Lock()
+        self.lines = []
+        self.buffered = 0
+        self.last_write = time()
+        self.fd = self._open()
+        atexit.register(self.close)
+
+    def log(self, formatter, time_stamp, tag, *values):
+        line = formatter.format(time_stamp, tag, *values)
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.lines:
+                self.min_time_stamp = min(self.min_time_stamp, time_stamp)
+                self.max_time_stamp = max(self.max_time_stamp, time_stamp)
+            else:
+                self.first_time_stamp = self.min_time_stamp = self.max_time_stamp = time_stamp
+            self.lines.append(line)
+            self.buffered += len(line) + 1
+            if self.buffered >= self.block_size or time() - self.last_write >= self.flush_interval:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None:
+                self._write()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._write()
+                os.close(self.fd)
+                self.fd = None
+
+    def _open(self):
+        return os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _write(self):
+        if self.lines:
+            if self._rotated():
+                os.close(self.fd)
+                self.fd = self._open()
+            data = zlib.compress('\n'.join(self.lines) + '\n', self.level)
+            os.write(self.fd, BlockFormat.HEADER.pack(BlockFormat.MAGIC, len(data), self.first_time_stamp,
+                                                      self.min_time_stamp, self.max_time_stamp) + data)
+            self.lines = []
+            self.buffered = 0
+        self.last_write = time()
+
+    def _rotated(self):
+        try:
+            return os.stat(self.file_name).st_ino != os.fstat(self.fd).st_ino
+        except OSError:
+            return True
+
+
+class ShardedFileMetricLogger(MetricLogger):
+    """
+    Writes events to one file per process in directory, so worker processes never share a file or a lock. Lines are
+    buffered and written in batches of batch_size, or when flush_interval seconds have passed since the last write.
+    A process forked from a logging process starts its own file on its first event, without writing the buffered
+    lines of the parent. Pending lines are written on close(), which is also called at interpreter exit.
+    """
+
+    def __init__(self, directory, prefix='metrics', batch_size=100, flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pid = None
+        self.fd = None
+        self._open()
+        atexit.register(self.close)
+
+    @property
+    def file_name(self):
+        return os.path.join(self.directory, '{}-{}.log'.format(self.prefix, self.pid))
+
+    def log(self, formatter, time_stamp, tag, *values):
+        if self.pid != os.getpid():
+            self._open()
+        line = formatter.format(time_stamp, tag, *values)
+        with self.lock:
+            if self.fd is None:
+                return
+            self.lines.append(line)
+            if len(self.lines) >= self.batch_size or time() - self.last_write >= self.flush_interval:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None and self.pid == os.getpid():
+                self._write()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None and self.pid == os.getpid():
+                self._write()
+                os.close(self.fd)
+                self.fd = None
+
+    def _open(self):
+        # Called in the parent, or in a forked child where the inherited lock may be held and the buffered lines
+        # belong to the parent
+        if self.fd is not None:
+            os.close(self.fd)
+        self.lock = threading.Lock()
+        self.lines = []
+        self.last_write = time()
+        self.pid = os.getpid()
+        self.fd = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
 
+    def _write(self):
+        if self.lines:
+            os.write(self.fd, '\n'.join(self.lines) + '\n')
+            self.lines = []
+        self.last_write = time()
@@ -0,0 +1,275 @@
+"""
+Benchmarks for the logging hot path and the log parser. Results are written as JSON, e.g.
+
+    python benchmark.py -o before.json
+    python benchmark.py --lines 1000000 --tags 1000 --order shuffled -o after.json
+
+Logging results are in ns/op, where contended runs divide the wall time by the total number of operations over all
+threads. Parser results are in lines/sec, with the peak resident memory of the parsing process in KB.
+"""
+import os, sys, json, time, random, tempfile, shutil, logging, threading, multiprocessing, resource, platform, \
+    argparse, subprocess, socket
+from context import Timer, Counter, MetricLogger, LoggingMetricLogger, AggregatingMetricLogger, \
+    ThreadLocalAggregatingMetricLogger, AsyncFileMetricLogger, BinaryMetricLogger, ShardedFileMetricLogger, \
+    CompactFileMetricLogger, BlockFileMetricLogger, SocketMetricLogger, LiveStatsMetricLogger, \
+    AdaptiveSamplingMetricLogger, LogParser, span
+from stopwatch.stopwatch import PrintMetricLogger, timer_formatter, counter_formatter
+
+
+class NullMetricLogger(MetricLogger):
+    def log(self, formatter, time_stamp, tag, *values):
+        pass
+
+
+def make_loggers(directory):
+    """
+    Returns (name, logger, close) for every MetricLogger, writing to files in directory or discarding output.
+    """
+    logger = logging.getLogger('stopwatch.benchmark')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.FileHandler(os.devnull))
+
+    async_logger = AsyncFileMetricLogger(os.path.join(directory, 'async.log'))
+    binary_logger = BinaryMetricLogger(os.path.join(directory, 'binary.log'))
+    aggregating_logger = AggregatingMetricLogger(NullMetricLogger())
+    thread_local_logger = ThreadLocalAggregatingMetricLogger(NullMetricLogger())
+    # A low rate, so that nearly every event takes the throttled path
+    sampling_logger = AdaptiveSamplingMetricLogger(NullMetricLogger(), lines_per_second=10)
+    sharded_logger = ShardedFileMetricLogger(directory)
+    compact_logger = CompactFileMetricLogger(os.path.join(directory, 'compact.log'))
+    block_logger = BlockFileMetricLogger(os.path.join(directory, 'block.log'))
+    # Nothing reads the socket, so only the cost in the logging process is measured. Datagrams that do not fit in its
+    # receive buffer are counted as dropped, at the cost of a failed send.
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(os.path.join(directory, 'collector.sock'))
+    socket_logger = SocketMetricLogger(receiver.getsockname())
+
+    def close_socket_logger():
+        socket_logger.close()
+        receiver.close()
+
+    return [
+        ('null', NullMetricLogger(), lambda: None),
+        ('print', PrintMetricLogger(), lambda: None),
+        ('logging', LoggingMetricLogger(logger), lambda: None),
+        ('aggregating', aggregating_logger, aggregating_logger.flush),
+        ('thread_local', thread_local_logger, thread_local_logger.flush),
+        ('adaptive_sampling', sampling_logger, lambda: None),
+        ('async', async_logger, async_logger.close),
+        ('binary', binary_logger, binary_logger.close),
+        ('sharded', sharded_logger, sharded_logger.close),
+        ('compact', compact_logger, compact_logger.close),
+        ('block', block_logger, block_logger.close),
+        ('socket', socket_logger, close_socket_logger),
+        ('live_stats', LiveStatsMetricLogger(), lambda: None)
+    ]
+
+
+def timer_stop(logger, tags):
+    timer = Timer(logger)
+    stop = timer.stop
+    for tag in tags:
+        stop(tag)
+
+
+def timer_lap(logger, tags):
+    timer = Timer(logger)
+    lap = timer.lap
+    for tag in tags:
+        lap(tag)
+
+
+def counter_incr(logger, tags):
+    counter = Counter(logger)
+    incr = counter.incr
+    for tag in tags:
+        incr(tag)
+
+
+def nested_span(logger, tags):
+    with span('benchmark.root', logger):
+        for tag in tags:
+            with span(tag, logger):
+                pass
+
+operations = [('Timer.stop', timer_stop), ('Timer.lap', timer_lap), ('Counter.incr', counter_incr),
+              ('span', nested_span)]
+
+
+def time_operation(operation, logger, tags, threads):
+    """
+    Runs operation over tags in every thread and returns the wall time in ns per operation.
+    """
+    workers = [threading.Thread(target=operation, args=(logger, tags)) for _ in range(threads)]
+    start_time = time.time()
+    if threads == 1:
+        operation(logger, tags)
+    else:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return (time.time() - start_time) * 1e9 / (len(tags) * threads)
+
+
+def bench_logging(operation_count, tag_count, threads, repeat):
+    results = []
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        sys.stdout = open(os.devnull, 'w')
+        tag_names = ['benchmark.tag.{}'.format(i) for i in range(tag_count)]
+        tags = [tag_names[i % tag_count] for i in range(operation_count)]
+        for name, logger, close in make_loggers(directory):
+            for operation_name, operation in operations:
+                for thread_count in sorted(set([1, threads])):
+                    ns_per_op = min(time_operation(operation, logger, tags, thread_count) for _ in range(repeat))
+                    results.append({
+                        'logger': name,
+                        'operation': operation_name,
+                        'threads': thread_count,
+                        'operations': operation_count * thread_count,
+                        'ns_per_op': round(ns_per_op, 1)
+                    })
+            close()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+    return results
+
+
+def write_log(file_name, line_count, tag_count, order, log_format='text', seed=0):
+    """
+    Writes a synthetic log of timer and counter lines over an hour. Order is one of sorted, shuffled or reversed time
+    stamps, and log_format is text, compact or block.
+    """
+    rand = random.Random(seed)
+    tags = ['benchmark.tag.{}'.format(i) for i in range(tag_count)]
+    counter_tags = ['benchmark.count.{}'.format(i) for i in range(tag_count)]
+    start_time = 1400000000
+    time_stamps = [start_time + i * 3600.0 / line_count for i in range(line_count)]
+    if order == 'shuffled':
+        rand.shuffle(time_stamps)
+    elif order == 'reversed':
+        time_stamps.reverse()
+    if log_format in ('compact', 'block'):
+        logger = (CompactFileMetricLogger if log_format == 'compact' else BlockFileMetricLogger)(file_name)
+        for time_stamp in time_stamps:
+            tag_index = rand.randrange(tag_count)
+            if rand.random() < 0.8:
+                logger.log(timer_formatter, time_stamp, tags[tag_index], rand.expovariate(10), 1)
+            else:
+                logger.log(counter_formatter, time_stamp, counter_tags[tag_index], rand.randint(1, 10))
+        logger.close()
+        return
+    with open(file_name, 'w') as log_file:
+        for time_stamp in time_stamps:
+            tag_index = rand.randrange(tag_count)
+            if rand.random() < 0.8:
+                line = timer_formatter.format(time_stamp, tags[tag_index], rand.expovariate(10), 1)
+            else:
+                line = counter_formatter.format(time_stamp, counter_tags[tag_index], rand.randint(1, 10))
+            log_file.write(line + '\n')
+
+
+def _parse(file_name, interval, jobs, queue):
+    start_time = time.time()
+    LogParser(file_name, verbose=False, interval=interval, jobs=jobs).parse()
+    elapsed_time = time.time() - start_time
+    queue.put((elapsed_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def parse_in_process(file_name, interval, jobs):
+    """
+    Returns the parse time and peak resident memory in KB of a fresh process. Parallel jobs are not included in the
+    memory figure.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_parse, args=(file_name, interval, jobs, queue))
+    process.start()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError('Parser benchmark failed with exit code {}'.format(process.exitcode))
+    return queue.get()
+
+
+def bench_parser(line_count, tag_count, order, log_format, intervals, jobs, repeat):
+    """
+    Parses a synthetic log in a fresh process per run, so peak memory is not inflated by earlier runs.
+    """
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(directory, 'benchmark.log')
+        write_log(file_name, line_count, tag_count, order, log_format)
+        for interval in intervals:
+            for job_count in sorted(set([1, jobs])):
+                runs = [parse_in_process(file_name, interval, job_count) for _ in range(repeat)]
+                elapsed_time = min(run[0] for run in runs)
+                results.append({
+                    'lines': line_count,
+                    'tags': tag_count,
+                    'order': order,
+                    'format': log_format,
+                    'interval': interval,
+                    'jobs': job_count,
+                    'bytes': os.path.getsize(file_name),
+                    'lines_per_sec': int(line_count / elapsed_time),
+                    'peak_rss_kb': max(run[1] for run in runs)
+                })
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the stopwatch loggers and log parser.')
+parser.add_argument('-o', '--output', help='output file, default stdout')
+parser.add_argument('--operations', help='operations per logging benchmark and thread', type=int, default=20000)
+parser.add_argument('--threads', help='threads in the contended logging benchmarks', type=int, default=4)
+parser.add_argument('--lines', help='lines in the synthetic log', type=int, default=200000)
+parser.add_argument('--tags', help='distinct tags', type=int, default=100)
+parser.add_argument('--order', help='time stamp order of the synthetic log', choices=['sorted', 'shuffled', 'reversed'],
+                    default='sorted')
+parser.add_argument('--format', help='format of the synthetic log', choices=['text', 'compact', 'block'],
+                    default='text')
+parser.add_argument('--intervals', help='comma separated parser intervals in seconds, 0 for none', default='0,60')
+parser.add_argument('-j', '--jobs', help='parser jobs, in addition to a single job', type=int, default=1)
+parser.add_argument('--repeat', help='runs per benchmark, the best is reported', type=int, default=3)
+parser.add_argument('--skip-logging', help='skip the logging benchmarks', action='store_true', default=False)
+parser.add_argument('--skip-parser', help='skip the parser benchmarks', action='store_true', default=False)
+
+
+def main(args):
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'logging': [],
+        'parser': []
+    }
+    if not args.skip_logging:
+        results['logging'] = bench_logging(args.operations, args.tags, args.threads, args.repeat)
+    if not args.skip_parser:
+        intervals = [int(interval) for interval in args.intervals.split(',')]
+        results['parser'] = bench_parser(args.lines, args.tags, args.order, args.format, intervals, args.jobs,
+                                         args.repeat)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -2,7 +2,14 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath('..'))
 
-from stopwatch import MetricLogger, Timer, Counter, LoggingMetricLogger
+from stopwatch import MetricLogger, Timer, Counter, Gauge, LoggingMetricLogger, AggregatingMetricLogger, \
+    ThreadLocalAggregatingMetricLogger, AsyncFileMetricLogger, BinaryMetricLogger, ShardedFileMetricLogger, \
+    SocketMetricLogger, CompactFileMetricLogger, BlockFileMetricLogger, AdaptiveSamplingMetricLogger, \
+    LiveStatsMetricLogger, QuantileSketch, timed, span, counted, settings
+from stopwatch.stopwatch import timer_formatter
+from stopwatch.collector import Collector
+from stopwatch.logparser import AggregateStats, LogParser, Checkpoint, TagFilter, RollupIndex, CollapsedOutput, \
+    parse_time, positive_int, span_times
 
 
 class MockMetricLogger(MetricLogger):
@@ -10,9 +17,11 @@ class MockMetricLogger(MetricLogger):
         self.logged_events = []
         self.formatter = None
 
-    def log(self, formatter, **kwargs):
+    def log(self, formatter, time_stamp, tag, *values):
         self.formatter = formatter
-        self.logged_events.append(kwargs)
+        event = dict(zip(formatter.FIELDS, values))
+        event.update(time_stamp=time_stamp, tag=tag)
+        self.logged_events.append(event)
 
     def log_count(self):
         return len(self.logged_events)
@@ -22,15 +31,17 @@ class InMemoryLogger(MetricLogger):
     def __init__(self):
         self.logged_events = []
 
-    def log(self, formatter, **kwargs):
-        self.logged_events.append(formatter.format(**kwargs))
+    def log(self, formatter, time_stamp, tag, *values):
+        self.logged_events.append(formatter.format(time_stamp, tag, *values))
 
 
 class MockClock(object):
     def __init__(self, current_time=1):
         self.current_time = current_time
+        self.calls = 0
 
     def __call__(self, *args, **kwargs):
+        self.calls += 1
         return self.current_time
 
     def tick(self):
@@ -1,6 +1,10 @@
-import unittest
+import unittest, tempfile, shutil, os, sys, threading, subprocess, gzip, time, random, argparse, StringIO, struct
 
-from context import Timer, Counter, MockClock, MockMetricLogger, MockRand, InMemoryLogger
+from context import Timer, Counter, Gauge, MockClock, MockMetricLogger, MockRand, InMemoryLogger, \
+    AggregatingMetricLogger, ThreadLocalAggregatingMetricLogger, AggregateStats, AsyncFileMetricLogger, \
+    BinaryMetricLogger, ShardedFileMetricLogger, SocketMetricLogger, CompactFileMetricLogger, BlockFileMetricLogger, \
+    AdaptiveSamplingMetricLogger, Collector, LiveStatsMetricLogger, LogParser, QuantileSketch, Checkpoint, TagFilter, \
+    RollupIndex, CollapsedOutput, parse_time, positive_int, span_times, timed, span, counted, settings, timer_formatter
 
 
 class TimerTest(unittest.TestCase):
@@ -184,6 +188,19 @@ class TimerTest(unittest.TestCase):
 
         self.assertEqual(self.logger.logged_events[0]['event_count'], 2)
 
+    def test_should_not_sample_without_sample_rate(self):
+        self.timer.rand = None
+        self.timer.stop('test')
+
+        self.assertEqual(self.logger.log_count(), 1)
+
+    def test_default_clock_should_log_wall_clock_time_stamp(self):
+        timer = Timer(self.logger)
+        timer.stop('test')
+
+        self.assertAlmostEqual(self.logger.logged_events[0]['time_stamp'], time.time(), delta=1)
+        self.assertTrue(self.logger.logged_events[0]['elapsed_time'] >= 0)
+
     def test_timer_format(self):
         logger = InMemoryLogger()
         self.timer.logger = logger
@@ -194,6 +211,167 @@ class TimerTest(unittest.TestCase):
         self.assertEqual(log_line, '<|0|test.tag|1.000000|1|t|>')
 
 
+class TimedTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.logger = MockMetricLogger()
+
+    def tearDown(self):
+        settings.enabled = True
+
+    def test_context_manager(self):
+        with timed('test.tag', self.logger, clock=self.clock):
+            self.clock.tick()
+        self.assertEqual(self.logger.logged_events,
+                         [{'time_stamp': 0, 'tag': 'test.tag', 'elapsed_time': 1, 'event_count': 1}])
+
+    def test_decorator(self):
+        @timed('test.tag', self.logger, clock=self.clock)
+        def foo(value):
+            self.clock.tick()
+            return value
+
+        self.assertEqual(foo(2), 2)
+        self.assertEqual(foo.__name__, 'foo')
+        self.assertEqual(self.logger.log_count(), 1)
+        self.assertEqual(self.logger.logged_events[0]['elapsed_time'], 1)
+
+    def test_decorator_logs_on_exception(self):
+        @timed('test.tag', self.logger, clock=self.clock)
+        def foo():
+            raise ValueError()
+
+        self.assertRaises(ValueError, foo)
+        self.assertEqual(self.logger.log_count(), 1)
+
+    def test_sampled_out_does_not_read_clock(self):
+        decorator = timed('test.tag', self.logger, sample_rate=0.5, clock=self.clock)
+        decorator.rand = MockRand(0.6)
+        decorator(lambda: None)()
+        with decorator:
+            pass
+        self.assertEqual(self.clock.calls, 0)
+        self.assertEqual(self.logger.log_count(), 0)
+
+        decorator.rand = MockRand(0.4)
+        decorator(lambda: None)()
+        self.assertEqual(self.logger.logged_events[0]['event_count'], 2)
+
+    def test_threshold(self):
+        with timed('test.tag', self.logger, threshold=2, clock=self.clock):
+            self.clock.tick()
+        self.assertEqual(self.logger.log_count(), 0)
+
+    def test_disabled(self):
+        settings.enabled = False
+
+        @timed('test.tag', self.logger, clock=self.clock)
+        def foo():
+            pass
+
+        foo()
+        with timed('test.tag', self.logger, clock=self.clock):
+            pass
+        self.assertEqual(self.clock.calls, 0)
+        self.assertEqual(self.logger.log_count(), 0)
+
+    def test_default_logger(self):
+        settings.logger = self.logger
+        try:
+            with timed('test.tag', clock=self.clock):
+                pass
+        finally:
+            settings.logger = None
+        self.assertEqual(self.logger.log_count(), 1)
+
+
+class CountedTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = MockMetricLogger()
+
+    def tearDown(self):
+        settings.enabled = True
+
+    def test_counts_calls(self):
+        @counted('test.tag', 2, self.logger, clock=MockClock(5))
+        def foo(value):
+            return value
+
+        self.assertEqual(foo(1), 1)
+        foo(2)
+        self.assertEqual(self.logger.logged_events,
+                         [{'time_stamp': 5, 'tag': 'test.tag', 'event_count': 2}] * 2)
+
+    def test_disabled(self):
+        settings.enabled = False
+        counted('test.tag', logger=self.logger)(lambda: None)()
+        self.assertEqual(self.logger.log_count(), 0)
+
+
+class SpanTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.logger = MockMetricLogger()
+
+    def tearDown(self):
+        settings.enabled = True
+
+    def logged_paths(self):
+        return [(event['tag'], event['time_stamp'], event['elapsed_time']) for event in self.logger.logged_events]
+
+    def test_should_log_path_of_nested_spans(self):
+        @span('db.query', self.logger, clock=self.clock)
+        def query():
+            self.clock.tick()
+
+        with span('http.request', self.logger, clock=self.clock):
+            query()
+            with span('render', self.logger, clock=self.clock):
+                self.assertEqual(span.current_path(), 'http.request;render')
+                self.clock.tick()
+        query()
+
+        self.assertEqual(self.logged_paths(), [('http.request;db.query', 0, 1),
+                                               ('http.request;render', 1, 1),
+                                               ('http.request', 0, 2),
+                                               ('db.query', 2, 1)])
+        self.assertEqual(span.current_path(), None)
+
+    def test_should_restore_path_on_exception(self):
+        @span('inner', self.logger, clock=self.clock)
+        def inner():
+            raise ValueError()
+
+        with span('outer', self.logger, clock=self.clock):
+            self.assertRaises(ValueError, inner)
+            self.assertEqual(span.current_path(), 'outer')
+        self.assertEqual([path for path, _, _ in self.logged_paths()], ['outer;inner', 'outer'])
+
+    def test_should_keep_path_per_thread(self):
+        paths = []
+
+        def worker():
+            paths.append(span.current_path())
+            with span('worker', self.logger, clock=self.clock):
+                paths.append(span.current_path())
+
+        with span('main', self.logger, clock=self.clock):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            self.assertEqual(span.current_path(), 'main')
+        self.assertEqual(paths, [None, 'worker'])
+
+    def test_disabled(self):
+        settings.enabled = False
+
+        with span('outer', self.logger, clock=self.clock):
+            span('inner', self.logger, clock=self.clock)(lambda: None)()
+            self.assertEqual(span.current_path(), None)
+        self.assertEqual(self.logger.log_count(), 0)
+        self.assertEqual(self.clock.calls, 0)
+
+
 class CounterTest(unittest.TestCase):
     def setUp(self):
         self.logger = MockMetricLogger()
@@ -224,6 +402,12 @@ class CounterTest(unittest.TestCase):
 
         self.assertEqual(self.logger.logged_events[0]['event_count'], 7)
 
+    def test_should_not_sample_without_sample_rate(self):
+        self.counter.rand = None
+        self.counter.incr('test')
+
+        self.assertEqual(self.logger.log_count(), 1)
+
     def test_counter_format(self):
         logger = InMemoryLogger()
         self.counter.logger = logger
@@ -294,9 +478,1673 @@ class CounterTest(unittest.TestCase):
 
         self.assertEqual(self.logger.logged_events[0]['event_count'], 2)
 
+    def test_unsampled_count_should_round_to_nearest_integer(self):
+        self.counter.incr('test', 2.6)
+
+        self.assertEqual(self.logger.logged_events[0]['event_count'], 3)
+        self.assertEqual(type(self.logger.logged_events[0]['event_count']), int)
+
+
+class ThreadLocalAggregatingMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.out = InMemoryLogger()
+        self.logger = ThreadLocalAggregatingMetricLogger(self.out, interval=10, clock=self.clock)
+
+    def run_threads(self, target, count):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_should_merge_threads_on_flush(self):
+        def incr():
+            counter = Counter(self.logger, self.clock)
+            for _ in range(1000):
+                counter.incr('test')
+
+        self.run_threads(incr, 4)
+        Counter(self.logger, self.clock).incr('test')
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|4001|c|>'])
+        self.assertEqual(len(self.logger.slots), 1)
+
+    def test_should_merge_timer_rollups(self):
+        elapsed_times = iter([1, 2, 4])
+
+        def lap():
+            clock = MockClock(0)
+            timer = Timer(self.logger, clock)
+            clock.set(next(elapsed_times))
+            timer.stop('test')
+
+        self.run_threads(lap, 3)
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|7.000000|3|1.000000|4.000000|t|>'])
+
+    def test_should_write_when_interval_has_passed(self):
+        counter = Counter(self.logger, self.clock)
+        counter.incr('test')
+        self.run_threads(lambda: counter.incr('test'), 2)
+        self.clock.set(10)
+        counter.incr('test')
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|3|c|>'])
+
+    def test_should_start_new_interval_with_event_after_idle_period(self):
+        counter = Counter(self.logger, self.clock)
+        counter.incr('a')
+        self.clock.set(3600)
+        counter.incr('b')
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|a|1|c|>', '<|3600|b|1|c|>'])
+
+    def test_no_lost_updates_while_flushing(self):
+        def incr():
+            counter = Counter(self.logger, self.clock)
+            for _ in range(2000):
+                counter.incr('test')
+
+        threads = [threading.Thread(target=incr) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self.logger.flush()
+        for thread in threads:
+            thread.join()
+        self.logger.flush()
+
+        self.assertEqual(sum(int(line.split('|')[3]) for line in self.out.logged_events), 8000)
+
+
+class AdaptiveSamplingMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.out = MockMetricLogger()
+
+    def sampler(self, **kwargs):
+        sampler = AdaptiveSamplingMetricLogger(self.out, window=1, clock=self.clock, **kwargs)
+        sampler.rand = MockRand(0)
+        return sampler
+
+    def incr(self, sampler, tag, times):
+        counter = Counter(sampler, self.clock)
+        for _ in range(times):
+            counter.incr(tag, 2)
+
+    def test_should_log_all_events_in_first_window(self):
+        sampler = self.sampler(lines_per_second=10)
+        self.incr(sampler, 'test', 50)
+
+        self.assertEqual(self.out.log_count(), 50)
+
+    def test_should_scale_counts_of_throttled_tag(self):
+        sampler = self.sampler(lines_per_second=10)
+        self.incr(sampler, 'test', 40)
+        self.clock.set(1)
+        self.incr(sampler, 'test', 1)
+
+        self.assertEqual(sampler.factors, {'test': 4})
+        self.assertEqual(self.out.logged_events[-1]['event_count'], 8)
+
+        sampler.rand = MockRand(0.25)
+        self.incr(sampler, 'test', 1)
+        self.assertEqual(self.out.log_count(), 41)
+
+    def test_should_log_timers_as_scaled_rollups(self):
+        sampler = self.sampler(lines_per_second=1)
+        timer = Timer(sampler, self.clock)
+        timer.stop('test')
+        timer.stop('test')
+        self.clock.set(1)
+        timer.stop('test')
+
+        self.assertEqual(self.out.formatter.TYPE, 't')
+        self.assertEqual(self.out.logged_events[-1],
+                         {'time_stamp': 0, 'tag': 'test', 'elapsed_time': 2, 'event_count': 2, 'min_time': 1,
+                          'max_time': 1})
+
+    def test_should_keep_timer_average_when_throttled(self):
+        sampler = self.sampler(lines_per_second=1)
+        stats = AggregateStats(60)
+        sampler.log(timer_formatter, 0, 'test', 1.0, 2)
+        sampler.log(timer_formatter, 0, 'test', 1.0, 2)
+        self.clock.set(1)
+        sampler.log(timer_formatter, 0, 'test', 1.0, 2)
+        for event in self.out.logged_events:
+            values = [event['elapsed_time'], event['event_count']]
+            if 'min_time' in event:
+                values += [event['min_time'], event['max_time']]
+            stats.add(0, 'test', 't', values)
+
+        # The second window is throttled by 2
+        self.assertEqual([event['event_count'] for event in self.out.logged_events], [2, 2, 4])
+        timer_stats = stats.buckets[0].stats['test']
+        self.assertEqual(timer_stats.event_count, 8)
+        self.assertEqual(timer_stats.average, 0.5)
+
+    def test_per_tag_budget_should_not_throttle_rare_tags(self):
+        sampler = self.sampler(lines_per_second=10)
+        self.incr(sampler, 'hot', 100)
+        self.incr(sampler, 'rare', 5)
+        self.clock.set(1)
+        self.incr(sampler, 'rare', 1)
+
+        self.assertEqual(sampler.factors, {'hot': 10})
+
+    def test_overall_budget_should_be_shared_fairly(self):
+        sampler = self.sampler(lines_per_second=30, per_tag=False)
+        self.incr(sampler, 'hot', 100)
+        self.incr(sampler, 'warm', 40)
+        self.incr(sampler, 'rare', 5)
+        self.clock.set(1)
+        self.incr(sampler, 'rare', 1)
+
+        # 25 lines are left for hot and warm after rare, 12.5 each
+        self.assertEqual(sampler.factors, {'hot': 8, 'warm': 4})
+
+    def test_overall_budget_should_not_sample_when_all_tags_fit(self):
+        sampler = self.sampler(lines_per_second=30, per_tag=False)
+        self.incr(sampler, 'a', 10)
+        self.incr(sampler, 'b', 10)
+        self.clock.set(1)
+        self.incr(sampler, 'a', 1)
+
+        self.assertEqual(sampler.factors, {})
+
+    def test_projection_should_be_unbiased(self):
+        sampler = AdaptiveSamplingMetricLogger(self.out, lines_per_second=50, clock=self.clock)
+        sampler.rand = random.Random(0).random
+        counter = Counter(sampler, self.clock)
+        for second in range(10):
+            self.clock.set(second)
+            for _ in range(1000):
+                counter.incr('test')
+
+        logged = sum(event['event_count'] for event in self.out.logged_events)
+        self.assertLess(self.out.log_count(), 1500)
+        self.assertAlmostEqual(logged, 10000, delta=1000)
+
+
+class LiveStatsMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(100)
+        self.logger = LiveStatsMetricLogger(window=10, clock=self.clock)
+
+    def lap(self, tag, elapsed_times):
+        clock = MockClock(0)
+        timer = Timer(self.logger, clock)
+        for elapsed_time in elapsed_times:
+            clock.current_time += elapsed_time
+            timer.lap(tag)
+
+    def test_should_report_count_rate_and_average(self):
+        self.lap('test', [1, 2, 3])
+        self.clock.tick()
+        self.lap('test', [6])
+
+        stats = self.logger.stats('test')
+        self.assertEqual(stats.event_count, 4)
+        self.assertEqual(stats.rate, 0.4)
+        self.assertEqual(stats.average, 3)
+        self.assertEqual(self.logger.stats('test', 1).event_count, 1)
+
+    def test_should_report_quantiles(self):
+        self.lap('test', range(1, 101))
+
+        stats = self.logger.stats('test')
+        self.assertAlmostEqual(stats.percentile(50), 50, delta=1)
+        self.assertAlmostEqual(stats.percentile(99), 99, delta=1.5)
+
+    def test_should_slide_window(self):
+        counter = Counter(self.logger, self.clock)
+        for _ in range(15):
+            counter.incr('test', 2)
+            self.clock.tick()
+
+        stats = self.logger.stats('test')
+        self.assertEqual(stats.event_count, 18)
+        self.assertEqual(stats.average, 0.0)
+
+    def test_should_count_sampled_events(self):
+        clock = MockClock(0)
+        timer = Timer(self.logger, clock)
+        timer.rand = MockRand(0)
+        clock.tick()
+        timer.stop('test', sample_rate=0.5)
+
+        stats = self.logger.stats('test')
+        self.assertEqual(stats.event_count, 2)
+        self.assertEqual(stats.average, 1)
+
+    def test_should_count_rolled_up_events(self):
+        aggregating_logger = AggregatingMetricLogger(self.logger, clock=self.clock)
+        clock = MockClock(0)
+        timer = Timer(aggregating_logger, clock)
+        for elapsed_time in [1, 3]:
+            clock.current_time += elapsed_time
+            timer.lap('test')
+        aggregating_logger.flush()
+
+        stats = self.logger.stats('test')
+        self.assertEqual(stats.event_count, 2)
+        self.assertEqual(stats.average, 2)
+
+    def test_should_drop_idle_tags(self):
+        self.lap('idle', [1])
+        self.clock.set(110)
+        self.lap('test', [1])
+
+        self.assertEqual(self.logger.tags(), ['test'])
+        self.assertEqual(self.logger.stats('idle').event_count, 0)
+
+    def test_should_pass_events_on(self):
+        out = MockMetricLogger()
+        logger = LiveStatsMetricLogger(out, clock=self.clock)
+        Counter(logger, self.clock).incr('test')
+
+        self.assertEqual(out.log_count(), 1)
+
+
+class GaugeTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.out = InMemoryLogger()
+        self.gauge = Gauge(self.out, interval=10, clock=self.clock)
+
+    def test_should_coalesce_values_within_interval(self):
+        self.gauge.set('test', 3)
+        self.gauge.set('test', 1)
+        self.gauge.set('test', 2)
+        self.assertEqual(len(self.out.logged_events), 0)
+
+        self.gauge.flush()
+        self.assertEqual(self.out.logged_events, ['<|0|test|2.000000|1.000000|3.000000|6.000000|3|g|>'])
+
+    def test_should_write_when_interval_has_passed(self):
+        self.gauge.set('test', 1)
+        self.clock.set(10)
+        self.gauge.set('test', 2)
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|1.000000|1.000000|1.000000|1.000000|1|g|>'])
+
+    def test_should_parse_gauge_lines(self):
+        aggregate_stats = AggregateStats(60)
+        for line in self.gauge_lines():
+            aggregate_stats.parse_line(line)
+
+        gauge_stats = aggregate_stats.buckets[0].stats['test']
+        self.assertEqual(gauge_stats.type, 'g')
+        self.assertEqual(gauge_stats.last, 4.0)
+        self.assertEqual(gauge_stats.min_value, 1.0)
+        self.assertEqual(gauge_stats.max_value, 5.0)
+        self.assertEqual(gauge_stats.event_count, 4)
+        self.assertEqual(gauge_stats.average, 3.0)
+
+    def test_rollup_should_keep_latest_value(self):
+        aggregate_stats = AggregateStats(10)
+        for line in self.gauge_lines():
+            aggregate_stats.parse_line(line)
+
+        gauge_stats = aggregate_stats.rollup(60).buckets[0].stats['test']
+        self.assertEqual(gauge_stats.last, 4.0)
+        self.assertEqual(gauge_stats.max_value, 5.0)
+
+    def gauge_lines(self):
+        for value in [1, 5]:
+            self.gauge.set('test', value)
+        self.gauge.flush()
+        self.clock.set(20)
+        for value in [2, 4]:
+            self.gauge.set('test', value)
+        self.gauge.flush()
+        return self.out.logged_events
+
+    def test_should_write_last_gauges_at_exit(self):
+        dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(dir, 'metrics.log')
+            script = ('import sys; sys.path.insert(0, {!r})\n'
+                      'from stopwatch import AsyncFileMetricLogger, Gauge\n'
+                      'Gauge(AsyncFileMetricLogger({!r})).set("test", 2.5)\n'
+                      ).format(os.path.abspath('..'), file_name)
+            subprocess.check_call([sys.executable, '-c', script])
+
+            with open(file_name) as log_file:
+                self.assertEqual(log_file.read().split('|')[2:4], ['test', '2.500000'])
+        finally:
+            shutil.rmtree(dir)
+
+
+class AggregatingMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock(0)
+        self.out = InMemoryLogger()
+        self.logger = AggregatingMetricLogger(self.out, interval=10, clock=self.clock)
+        self.timer = Timer(self.logger, self.clock)
+        self.counter = Counter(self.logger, self.clock)
+
+    def test_should_write_last_interval_at_exit(self):
+        dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(dir, 'metrics.log')
+            script = ('import sys; sys.path.insert(0, {!r})\n'
+                      'from stopwatch import AsyncFileMetricLogger, AggregatingMetricLogger, Counter\n'
+                      'Counter(AggregatingMetricLogger(AsyncFileMetricLogger({!r}))).incr("test", 3)\n'
+                      ).format(os.path.abspath('..'), file_name)
+            subprocess.check_call([sys.executable, '-c', script])
+
+            with open(file_name) as log_file:
+                self.assertEqual(log_file.read().split('|')[2:4], ['test', '3'])
+        finally:
+            shutil.rmtree(dir)
+
+    def test_should_not_write_within_interval(self):
+        self.counter.incr('test')
+        self.clock.tick()
+        self.timer.stop('test')
+
+        self.assertEqual(len(self.out.logged_events), 0)
+
+    def test_flush_should_write_one_line_per_tag(self):
+        self.counter.incr('test', 2)
+        self.counter.incr('test', 3)
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|5|c|>'])
+
+    def test_timer_rollup_format(self):
+        self.clock.set(2)
+        self.timer.lap('test')
+        self.clock.set(3)
+        self.timer.lap('test')
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|3.000000|2|1.000000|2.000000|t|>'])
+
+    def test_should_write_when_interval_has_passed(self):
+        self.counter.incr('test')
+        self.clock.set(10)
+        self.counter.incr('test')
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|1|c|>'])
+
+    def test_should_start_new_interval_after_write(self):
+        self.counter.incr('test')
+        self.clock.set(10)
+        self.counter.incr('test')
+        self.clock.set(15)
+        self.counter.incr('test')
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|1|c|>', '<|10|test|2|c|>'])
+
+    def test_should_start_new_interval_with_event_after_idle_period(self):
+        self.counter.incr('a')
+        self.clock.set(3600)
+        self.counter.incr('b')
+        self.logger.flush()
+
+        self.assertEqual(self.out.logged_events, ['<|0|a|1|c|>', '<|3600|b|1|c|>'])
+
+    def test_timers_and_counters_should_not_share_rollups(self):
+        self.counter.incr('test')
+        self.timer.stop('test')
+        self.logger.flush()
+
+        self.assertEqual(len(self.out.logged_events), 2)
+
+
+class BlockingFormatter(object):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def format(self, time_stamp, tag, *values):
+        self.release.wait()
+        return tag
+
+
+class AsyncFileMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_lines(self):
+        with open(self.file_name) as log_file:
+            return log_file.read().splitlines()
+
+    def test_close_should_write_pending_events(self):
+        logger = AsyncFileMetricLogger(self.file_name)
+        counter = Counter(logger, MockClock(15))
+        for i in range(5):
+            counter.incr('test')
+        logger.close()
+
+        self.assertEqual(self.read_lines(), ['<|15|test|1|c|>'] * 5)
+
+    def test_flush_should_write_pending_events(self):
+        logger = AsyncFileMetricLogger(self.file_name)
+        Counter(logger, MockClock(15)).incr('test', 7)
+        logger.flush()
+
+        self.assertEqual(self.read_lines(), ['<|15|test|7|c|>'])
+        logger.close()
+
+    def test_should_count_dropped_events_when_full(self):
+        logger = AsyncFileMetricLogger(self.file_name, max_queue_size=1, batch_size=1)
+        formatter = BlockingFormatter()
+        logger.log(formatter, 0, 'first')
+        while not logger.queue.empty():
+            pass
+        logger.log(formatter, 0, 'queued')
+        logger.log(formatter, 0, 'dropped')
+        formatter.release.set()
+        logger.close()
+
+        self.assertEqual(logger.dropped, 1)
+        self.assertEqual(self.read_lines(), ['first', 'queued'])
+
+    def test_should_not_log_after_close(self):
+        logger = AsyncFileMetricLogger(self.file_name)
+        logger.close()
+        Counter(logger).incr('test')
+
+        self.assertEqual(self.read_lines(), [])
+
+    def test_should_count_events_that_can_not_be_formatted(self):
+        logger = AsyncFileMetricLogger(self.file_name)
+        logger.log(timer_formatter, 15, 'bad', 'not a number', 1)
+        Counter(logger, MockClock(15)).incr('test')
+        logger.flush()
+
+        self.assertEqual(logger.errors, 1)
+        self.assertEqual(self.read_lines(), ['<|15|test|1|c|>'])
+        logger.close()
+
+    def test_flush_after_close_should_return(self):
+        logger = AsyncFileMetricLogger(self.file_name)
+        logger.close()
+        logger.flush()
+
+        self.assertFalse(logger.writer.is_alive())
+
+    def test_unknown_overflow_policy_should_raise(self):
+        self.assertRaises(ValueError, AsyncFileMetricLogger, self.file_name, overflow='foo')
+
+    def test_bad_path_should_raise(self):
+        self.assertRaises(IOError, AsyncFileMetricLogger, os.path.join(self.dir, 'missing', 'metrics.log'))
+
+    def test_should_not_block_when_writer_has_stopped(self):
+        logger = AsyncFileMetricLogger(self.file_name, max_queue_size=1, overflow=AsyncFileMetricLogger.BLOCK)
+        logger.queue.put((logger._CLOSE, None, None, None))
+        logger.writer.join()
+        Counter(logger).incr('test')
+        Counter(logger).incr('test')
+        logger.flush()
+        logger.close()
+
+        self.assertEqual(logger.dropped, 2)
+        self.assertEqual(self.read_lines(), [])
+
+
+class BinaryMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.bin')
+        self.clock = MockClock(15)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self):
+        return LogParser(self.file_name, interval=60).parse()
+
+    def test_should_parse_timers_and_counters(self):
+        logger = BinaryMetricLogger(self.file_name)
+        timer = Timer(logger, self.clock)
+        self.clock.tick()
+        timer.lap('test.timer')
+        timer.lap('test.timer')
+        Counter(logger, self.clock).incr('test.counter', 7)
+        logger.close()
+
+        stats = self.parse().buckets[0].stats
+        self.assertEqual(stats['test.timer'].event_count, 2)
+        self.assertEqual(stats['test.timer'].total_time, 1.0)
+        self.assertEqual(stats['test.counter'].event_count, 7)
+
+    def test_should_parse_timer_rollups(self):
+        logger = BinaryMetricLogger(self.file_name)
+        aggregating_logger = AggregatingMetricLogger(logger, clock=self.clock)
+        timer = Timer(aggregating_logger, self.clock)
+        self.clock.tick()
+        timer.lap('test')
+        self.clock.set(19)
+        timer.lap('test')
+        aggregating_logger.flush()
+        logger.close()
+
+        timer_stats = self.parse().buckets[0].stats['test']
+        self.assertEqual(timer_stats.event_count, 2)
+        self.assertEqual(timer_stats.total_time, 4.0)
+        self.assertEqual(timer_stats.min_time, 1.0)
+        self.assertEqual(timer_stats.max_time, 3.0)
+
+    def test_should_parse_gauges(self):
+        logger = BinaryMetricLogger(self.file_name)
+        gauge = Gauge(logger, clock=self.clock)
+        gauge.set('test', 2.5)
+        gauge.set('test', 0.5)
+        gauge.flush()
+        logger.close()
+
+        gauge_stats = self.parse().buckets[0].stats['test']
+        self.assertEqual(gauge_stats.last, 0.5)
+        self.assertEqual(gauge_stats.max_value, 2.5)
+        self.assertEqual(gauge_stats.average, 1.5)
+
+    def test_should_parse_appended_segments(self):
+        for count in [2, 3]:
+            logger = BinaryMetricLogger(self.file_name)
+            counter = Counter(logger, self.clock)
+            counter.incr('other')
+            counter.incr('test', count)
+            logger.close()
+
+        stats = self.parse().buckets[0].stats
+        self.assertEqual(stats['test'].event_count, 5)
+        self.assertEqual(stats['other'].event_count, 2)
+
+    def test_should_stop_at_truncated_or_unknown_records(self):
+        logger = BinaryMetricLogger(self.file_name)
+        counter = Counter(logger, self.clock)
+        counter.incr('test', 3)
+        counter.incr('truncated')
+        logger.close()
+        with open(self.file_name, 'rb') as log_file:
+            content = log_file.read()
+        # The tag record of 'truncated' starts after the magic, the tag record of 'test' and one counter record
+        tag_start = 4 + 3 + len('test') + 21
+
+        for tail in [content[:tag_start + 2], content[:tag_start + 5], content[:tag_start] + 'X' * 30]:
+            with open(self.file_name, 'wb') as log_file:
+                log_file.write(tail)
+            stats = LogParser(self.file_name, verbose=False).parse().buckets[0].stats
+            self.assertEqual(stats.keys(), ['test'])
+            self.assertEqual(stats['test'].event_count, 3)
+
+    def test_should_stop_at_undefined_tag_id(self):
+        logger = BinaryMetricLogger(self.file_name)
+        Counter(logger, self.clock).incr('test', 3)
+        logger.close()
+        with open(self.file_name, 'ab') as log_file:
+            log_file.write(struct.pack('<cIdq', 'c', 5, 15, 1))
+
+        stats = LogParser(self.file_name, verbose=False).parse().buckets[0].stats
+        self.assertEqual(stats.keys(), ['test'])
+        self.assertEqual(stats['test'].event_count, 3)
+
+    def test_should_write_byte_string_and_unicode_tags(self):
+        logger = BinaryMetricLogger(self.file_name)
+        counter = Counter(logger, self.clock)
+        counter.incr('caf\xc3\xa9')
+        counter.incr(u'caf\xe9')
+        logger.close()
+
+        self.assertEqual(self.parse().buckets[0].stats['caf\xc3\xa9'].event_count, 2)
+
+    def test_should_parse_text_log(self):
+        with open(self.file_name, 'w') as log_file:
+            log_file.write('<|15|test|7|c|>\n')
+
+        self.assertEqual(self.parse().buckets[0].stats['test'].event_count, 7)
+
+
+class ShardedFileMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.clock = MockClock(15)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_should_write_to_process_file(self):
+        logger = ShardedFileMetricLogger(self.dir)
+        Counter(logger, self.clock).incr('test', 3)
+        logger.close()
+
+        self.assertEqual(os.listdir(self.dir), ['metrics-{}.log'.format(os.getpid())])
+        with open(logger.file_name) as log_file:
+            self.assertEqual(log_file.read(), '<|15|test|3|c|>\n')
+
+    def test_should_buffer_until_batch_size(self):
+        logger = ShardedFileMetricLogger(self.dir, batch_size=2, flush_interval=60)
+        counter = Counter(logger, self.clock)
+        counter.incr('test')
+        self.assertEqual(os.path.getsize(logger.file_name), 0)
+        counter.incr('test')
+        self.assertEqual(os.path.getsize(logger.file_name), 2 * len('<|15|test|1|c|>\n'))
+        logger.close()
+
+    def test_forked_process_should_write_own_shard(self):
+        logger = ShardedFileMetricLogger(self.dir, flush_interval=60)
+        counter = Counter(logger, self.clock)
+        counter.incr('test', 2)
+
+        pid = os.fork()
+        if pid == 0:
+            counter.incr('test', 3)
+            logger.close()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        logger.close()
+
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        self.assertEqual(LogParser(self.dir).parse().buckets[0].stats['test'].event_count, 5)
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.dir, 'collector.sock')
+        self.clock = MockClock(0)
+        self.out = InMemoryLogger()
+        self.collector = Collector(self.address, self.out, interval=10, clock=self.clock)
+        self.logger = SocketMetricLogger(self.address)
+
+    def tearDown(self):
+        self.logger.close()
+        self.collector.close()
+        shutil.rmtree(self.dir)
+
+    def test_should_aggregate_events_from_socket(self):
+        timer = Timer(self.logger, self.clock)
+        self.clock.set(2)
+        timer.lap('test.timer')
+        self.clock.set(3)
+        timer.lap('test.timer')
+        Counter(self.logger, self.clock).incr('test.counter', 3)
+        gauge = Gauge(self.logger, clock=self.clock)
+        gauge.set('test.gauge', 1.5)
+        gauge.flush()
+        self.logger.flush()
+        self.collector.poll(1)
+        self.assertEqual(self.out.logged_events, [])
+
+        self.clock.set(10)
+        self.collector.poll(0)
+        self.assertEqual(sorted(self.out.logged_events), ['<|0|test.counter|3|c|>',
+                                                          '<|0|test.gauge|1.500000|1.500000|1.500000|1.500000|1|g|>',
+                                                          '<|0|test.timer|3.000000|2|1.000000|2.000000|t|>'])
+
+    def test_should_merge_rollups(self):
+        aggregating_logger = AggregatingMetricLogger(self.logger, clock=self.clock)
+        Timer(aggregating_logger, MockClock(0)).lap('test')
+        aggregating_logger.flush()
+        self.clock.set(5)
+        Timer(self.logger, MockClock(0)).stop('test')
+        self.logger.flush()
+        self.collector.poll(1)
+        self.collector.close()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|0.000000|2|0.000000|0.000000|t|>'])
+
+    def test_should_send_byte_string_tags(self):
+        Counter(self.logger, self.clock).incr('caf\xc3\xa9')
+        self.logger.flush()
+        self.collector.poll(1)
+        self.collector.close()
+
+        self.assertEqual(self.out.logged_events, ['<|0|caf\xc3\xa9|1|c|>'])
+
+    def test_should_count_bad_packets(self):
+        self.logger.socket.sendto('x', self.address)
+        self.collector.poll(1)
+
+        self.assertEqual(self.collector.errors, 1)
+
+    def test_should_not_block_when_collector_is_down(self):
+        self.collector.close()
+        counter = Counter(self.logger)
+        counter.incr('test')
+        counter.incr('test')
+        self.logger.flush()
+
+        self.assertEqual(self.logger.dropped, 2)
+
+    def test_should_send_full_packets(self):
+        self.logger.max_packet_size = 100
+        counter = Counter(self.logger, self.clock)
+        for _ in range(10):
+            counter.incr('test')
+        self.collector.poll(1)
+        self.collector.close()
+
+        # 25 bytes per event, so four events are sent in each of two full packets
+        self.assertEqual(self.out.logged_events, ['<|0|test|8|c|>'])
+
+    def test_udp(self):
+        collector = Collector(('127.0.0.1', 0), self.out, clock=self.clock)
+        logger = SocketMetricLogger(collector.address)
+        try:
+            Counter(logger, self.clock).incr('test', 2)
+            logger.flush()
+            collector.poll(1)
+        finally:
+            logger.close()
+            collector.close()
+
+        self.assertEqual(self.out.logged_events, ['<|0|test|2|c|>'])
+
+
+class CompactFileMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        self.clock = MockClock(1400000000)
+        self.logger = CompactFileMetricLogger(self.file_name, base_interval=60)
+
+    def tearDown(self):
+        self.logger.close()
+        shutil.rmtree(self.dir)
+
+    def log_events(self):
+        timer = Timer(self.logger, self.clock)
+        counter = Counter(self.logger, self.clock)
+        for _ in range(3):
+            self.clock.current_time += 40
+            timer.lap('test.timer')
+            counter.incr('test.counter', 2)
+        self.logger.flush()
+
+    def read_lines(self):
+        with open(self.file_name) as log_file:
+            return log_file.read().splitlines()
+
+    def test_should_write_compact_lines(self):
+        self.log_events()
+
+        self.assertEqual(self.read_lines(), ['<@|1400000000|>',
+                                             '<#|0|test.timer|>',
+                                             '<+|0.000|0|40.000000|1|t|>',
+                                             '<#|1|test.counter|>',
+                                             '<+|40.000|1|2|c|>',
+                                             '<+|40.000|0|40.000000|1|t|>',
+                                             '<@|1400000080|>',
+                                             '<#|0|test.counter|>',
+                                             '<+|0.000|0|2|c|>',
+                                             '<#|1|test.timer|>',
+                                             '<+|0.000|1|40.000000|1|t|>',
+                                             '<+|40.000|0|2|c|>'])
+
+    def test_should_parse_compact_log(self):
+        self.log_events()
+
+        aggregate_stats = LogParser(self.file_name, interval=60).parse()
+        self.assertEqual([bucket.start_time for bucket in aggregate_stats.buckets],
+                         [1400000000, 1400000060, 1400000120])
+        stats = aggregate_stats.buckets[1].stats
+        self.assertEqual(stats['test.timer'].event_count, 1)
+        self.assertEqual(stats['test.timer'].total_time, 40)
+        self.assertEqual(stats['test.counter'].event_count, 2)
+
+    def log_minutes(self, minutes):
+        # One segment per minute, with one counter event every 10 seconds
+        counter = Counter(self.logger, self.clock)
+        for _ in range(minutes * 6):
+            counter.incr('test.counter')
+            self.clock.current_time += 10
+        self.logger.flush()
+
+    def test_should_parse_segments_in_parallel(self):
+        self.log_minutes(10)
+
+        serial = LogParser(self.file_name, interval=60).parse()
+        parallel = LogParser(self.file_name, interval=60, jobs=3).parse()
+        self.assertEqual([bucket.start_time for bucket in parallel.buckets],
+                         [bucket.start_time for bucket in serial.buckets])
+        self.assertEqual([bucket.stats['test.counter'].event_count for bucket in parallel.buckets], [6] * 10)
+
+    def test_should_parse_time_range_from_base_line(self):
+        self.log_minutes(100)
+        parser = LogParser(self.file_name, time_from=1400003000, time_to=1400003120, slack=0)
+        parser.SEARCH_BLOCK_SIZE = 256
+        with open(self.file_name) as log_file:
+            log_file.seek(parser._next_base(log_file, parser._find_offset(log_file, 1400003000)))
+            base = float(log_file.readline().split('|')[1])
+        # Reading starts at most a few segments before the range
+        self.assertLessEqual(base, 1400003000)
+        self.assertGreaterEqual(base, 1400003000 - 180)
+
+        stats = parser.parse().buckets[0].stats
+        self.assertEqual(stats['test.counter'].event_count, 12)
+
+    def test_should_filter_tags(self):
+        self.log_events()
+
+        aggregate_stats = LogParser(self.file_name, tag_filter=TagFilter(['test.counter'])).parse()
+        self.assertEqual(aggregate_stats.buckets[0].stats.keys(), ['test.counter'])
+
+    def test_should_start_new_segment_after_rotation(self):
+        self.log_events()
+        os.rename(self.file_name, self.file_name + '.1')
+        self.log_events()
+
+        # The rotation is noticed when the base moves
+        self.assertEqual(self.read_lines()[:3], ['<@|1400000160|>', '<#|0|test.counter|>', '<+|0.000|0|2|c|>'])
+        stats = LogParser([self.file_name + '.1', self.file_name]).parse().buckets[0].stats
+        self.assertEqual(stats['test.counter'].event_count, 12)
+        self.assertEqual(stats['test.timer'].event_count, 6)
+
+    def test_should_parse_incrementally(self):
+        parser = LogParser(self.file_name)
+        timer = Timer(self.logger, self.clock)
+        timer.lap('test')
+        self.logger.flush()
+        checkpoint = parser.parse_from()
+        timer.lap('test')
+        self.logger.flush()
+
+        checkpoint = parser.parse_from(checkpoint)
+        self.assertEqual(checkpoint.aggregate_stats.buckets[0].stats['test'].event_count, 2)
+
+
+class BlockFileMetricLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        self.clock = MockClock(1400000000)
+        self.logger = BlockFileMetricLogger(self.file_name, flush_interval=3600)
+
+    def tearDown(self):
+        self.logger.close()
+        shutil.rmtree(self.dir)
+
+    def log_blocks(self, block_count):
+        # One block per minute, with ten timer and ten counter events
+        counter = Counter(self.logger, self.clock)
+        timer = Timer(self.logger, self.clock)
+        for _ in range(block_count):
+            for _ in range(10):
+                self.clock.current_time += 5
+                timer.start()
+                self.clock.current_time += 1
+                timer.stop('test.timer')
+                counter.incr('test.counter', 2)
+            self.logger.flush()
+
+    def read_block_index(self):
+        parser = LogParser(self.file_name)
+        with open(self.file_name, 'rb') as log_file:
+            return parser._read_block_index(log_file)
+
+    def test_should_write_block_index(self):
+        self.log_blocks(3)
+
+        self.assertEqual([block[2:] for block in self.read_block_index()],
+                         [(1400000005, 1400000005, 1400000060),
+                          (1400000065, 1400000065, 1400000120),
+                          (1400000125, 1400000125, 1400000180)])
+
+    def test_should_write_block_when_block_size_is_reached(self):
+        self.logger.close()
+        self.logger = BlockFileMetricLogger(self.file_name, block_size=100, flush_interval=3600)
+        counter = Counter(self.logger, self.clock)
+        for _ in range(10):
+            counter.incr('test.counter')
+
+        # Four lines of 27 bytes fill a block, and the last two lines are buffered until closed
+        self.assertEqual(len(self.read_block_index()), 2)
+        self.logger.close()
+        self.assertEqual(len(self.read_block_index()), 3)
+
+    def test_should_parse_block_log(self):
+        self.log_blocks(3)
+
+        aggregate_stats = LogParser(self.file_name, interval=60).parse()
+        self.assertEqual([bucket.start_time for bucket in aggregate_stats.buckets],
+                         [1400000005, 1400000065, 1400000125])
+        stats = aggregate_stats.buckets[1].stats
+        self.assertEqual(stats['test.counter'].event_count, 20)
+        self.assertEqual(stats['test.timer'].event_count, 10)
+        self.assertEqual(stats['test.timer'].total_time, 10)
+
+    def test_should_only_decompress_blocks_in_time_range(self):
+        self.log_blocks(5)
+        parser = LogParser(self.file_name, time_from=1400000070, time_to=1400000130)
+        read_blocks = []
+        read_block_lines = parser._read_block_lines
+
+        def record_blocks(log_file, blocks):
+            read_blocks.extend(block[2] for block in blocks)
+            return read_block_lines(log_file, blocks)
+        parser._read_block_lines = record_blocks
+
+        stats = parser.parse().buckets[0].stats
+        self.assertEqual(read_blocks, [1400000065, 1400000125])
+        self.assertEqual(stats['test.counter'].event_count, 20)
+
+    def test_should_parse_blocks_in_parallel(self):
+        self.log_blocks(5)
+
+        serial = LogParser(self.file_name, interval=60).parse()
+        parallel = LogParser(self.file_name, interval=60, jobs=2).parse()
+        self.assertEqual([bucket.start_time for bucket in parallel.buckets],
+                         [bucket.start_time for bucket in serial.buckets])
+        self.assertEqual([bucket.stats['test.timer'].event_count for bucket in parallel.buckets], [10] * 5)
+
+    def test_should_parse_complete_blocks_incrementally(self):
+        self.log_blocks(1)
+        with open(self.file_name, 'rb') as log_file:
+            content = log_file.read()
+        with open(self.file_name, 'ab') as log_file:
+            log_file.write(content[:20])
+        parser = LogParser(self.file_name)
+
+        checkpoint = parser.parse_from()
+        self.assertEqual(checkpoint.offset, len(content))
+        self.assertEqual(checkpoint.aggregate_stats.buckets[0].stats['test.timer'].event_count, 10)
+        with open(self.file_name, 'ab') as log_file:
+            log_file.write(content[20:])
+
+        checkpoint = parser.parse_from(checkpoint)
+        self.assertEqual(checkpoint.offset, 2 * len(content))
+        self.assertEqual(checkpoint.aggregate_stats.buckets[0].stats['test.timer'].event_count, 20)
+
+    def test_should_reopen_rotated_file(self):
+        self.log_blocks(1)
+        os.rename(self.file_name, self.file_name + '.1')
+        self.log_blocks(1)
+
+        stats = LogParser([self.file_name + '.1', self.file_name], interval=60).parse().buckets
+        self.assertEqual([bucket.stats['test.counter'].event_count for bucket in stats], [20, 20])
+
+
+class ParallelLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        with open(self.file_name, 'w') as log_file:
+            for time_stamp in range(30):
+                log_file.write('<|{}|test|1.000000|1|t|>\n'.format(time_stamp))
+                log_file.write('<|{}|test.count|2|c|>\n'.format(time_stamp))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_should_parse_same_totals_as_single_process(self):
+        serial = LogParser(self.file_name).parse().buckets[0].stats
+        parallel = LogParser(self.file_name, jobs=4).parse().buckets[0].stats
+
+        self.assertEqual(parallel['test'].event_count, serial['test'].event_count)
+
+    def test_should_align_buckets_across_processes(self):
+        stats = LogParser(self.file_name, interval=10, jobs=3).parse()
+
+        self.assertEqual([bucket.start_time for bucket in stats.buckets], [0, 10, 20])
+        self.assertEqual([bucket.stats['test'].event_count for bucket in stats.buckets], [10, 10, 10])
+
+    def test_parse_range_should_only_parse_lines_starting_in_range(self):
+        parser = LogParser(self.file_name)
+        line_length = len('<|0|test|1.000000|1|t|>\n')
+
+        stats = parser.parse_range(1, line_length + 1, 0)
+
+        self.assertEqual(stats.buckets[0].stats.keys(), ['test.count'])
+        self.assertEqual(stats.buckets[0].stats['test.count'].event_count, 2)
+
+
+class IncrementalLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        self.parser = LogParser(self.file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, data, file_name=None):
+        with open(file_name or self.file_name, 'a') as log_file:
+            log_file.write(data)
+
+    def event_count(self, checkpoint):
+        return checkpoint.aggregate_stats.buckets[0].stats['test'].event_count
+
+    def test_should_only_parse_appended_lines(self):
+        self.append('<|0|test|1|c|>\n')
+        checkpoint = self.parser.parse_from()
+        self.append('<|1|test|2|c|>\n')
+
+        checkpoint = self.parser.parse_from(checkpoint)
+
+        self.assertEqual(self.event_count(checkpoint), 3)
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.file_name))
+
+    def test_should_not_parse_partial_line(self):
+        self.append('<|0|test|1|c|>\n<|1|test|2')
+        checkpoint = self.parser.parse_from()
+        self.assertEqual(self.event_count(checkpoint), 1)
+
+        self.append('|c|>\n')
+        checkpoint = self.parser.parse_from(checkpoint)
+
+        self.assertEqual(self.event_count(checkpoint), 3)
+
+    def test_should_parse_rest_of_rotated_file(self):
+        self.append('<|0|test|1|c|>\n')
+        checkpoint = self.parser.parse_from()
+        self.append('<|1|test|2|c|>\n')
+        os.rename(self.file_name, self.file_name + '.1')
+        self.append('<|2|test|4|c|>\n')
+
+        checkpoint = self.parser.parse_from(checkpoint)
+
+        self.assertEqual(self.event_count(checkpoint), 7)
+
+    def test_should_parse_truncated_file_from_start(self):
+        self.append('<|0|test|1|c|>\n<|1|test|2|c|>\n')
+        checkpoint = self.parser.parse_from()
+        open(self.file_name, 'w').close()
+        self.append('<|2|test|4|c|>\n')
+
+        checkpoint = self.parser.parse_from(checkpoint)
+
+        self.assertEqual(self.event_count(checkpoint), 7)
+
+    def test_should_restore_saved_checkpoint(self):
+        checkpoint_file = os.path.join(self.dir, 'checkpoint')
+        self.assertEqual(Checkpoint.load(checkpoint_file), None)
+        self.append('<|0|test|1|c|>\n')
+        self.parser.parse_from().save(checkpoint_file)
+        self.append('<|1|test|2|c|>\n')
+
+        checkpoint = self.parser.parse_from(Checkpoint.load(checkpoint_file))
+
+        self.assertEqual(self.event_count(checkpoint), 3)
+
+    def test_should_not_resume_with_different_interval(self):
+        self.append('<|0|test|1|c|>\n')
+        checkpoint = self.parser.parse_from()
+
+        self.assertRaises(ValueError, LogParser(self.file_name, interval=60).parse_from, checkpoint)
+
+
+class MergedLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, file_name, lines, opener=open):
+        path = os.path.join(self.dir, file_name)
+        log_file = opener(path, 'wb')
+        log_file.write(''.join(line + '\n' for line in lines))
+        log_file.close()
+        return path
+
+    def test_should_merge_plain_and_compressed_files(self):
+        files = [self.write('metrics.log.2.gz', ['<|0|test|1|c|>', '<|20|test|2|c|>'], gzip.open),
+                 self.write('metrics.log.1', ['<|5|test|4|c|>', 'garbage', '<|25|test|8|c|>']),
+                 self.write('metrics.log', ['<|12|test|16|c|>'])]
+
+        stats = LogParser(files, interval=10).parse()
+
+        self.assertEqual([bucket.start_time for bucket in stats.buckets], [0, 10, 20])
+        self.assertEqual([bucket.stats['test'].event_count for bucket in stats.buckets], [5, 16, 10])
+
+    def test_should_use_earliest_time_stamp_as_origin(self):
+        files = [self.write('b.log', ['<|15|test|1|c|>']), self.write('a.log', ['<|3|test|1|c|>'])]
+
+        stats = LogParser(files, interval=10).parse()
+
+        self.assertEqual([bucket.start_time for bucket in stats.buckets], [3, 13])
+
+    def test_should_parse_single_compressed_file(self):
+        path = self.write('metrics.log.gz', ['<|0|test|1.000000|3|t|>'], gzip.open)
+
+        self.assertEqual(LogParser(path).parse().buckets[0].stats['test'].event_count, 3)
+
+    def test_should_merge_binary_files(self):
+        path = os.path.join(self.dir, 'metrics.bin')
+        logger = BinaryMetricLogger(path)
+        Counter(logger, MockClock(5)).incr('test', 4)
+        logger.close()
+        files = [path, self.write('metrics.log', ['<|0|test|1|c|>'])]
+
+        self.assertEqual(LogParser(files).parse().buckets[0].stats['test'].event_count, 5)
+
+
+class TimeRangeLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, time_stamps):
+        with open(self.file_name, 'w') as log_file:
+            for time_stamp in time_stamps:
+                log_file.write('<|{}|test|1|c|>\n'.format(time_stamp))
+
+    def event_count(self, parser):
+        return sum(bucket.stats['test'].event_count for bucket in parser.parse().buckets)
+
+    def test_should_only_include_lines_in_range(self):
+        self.write(range(100000))
+        parser = LogParser(self.file_name, time_from=50000, time_to=50010)
+
+        self.assertEqual(self.event_count(parser), 10)
+
+    def test_should_find_offset_close_to_start_of_range(self):
+        self.write(range(100000))
+        parser = LogParser(self.file_name)
+
+        with open(self.file_name, 'rb') as log_file:
+            offset = parser._find_offset(log_file, 50000)
+
+        line_length = len('<|50000|test|1|c|>\n')
+        self.assertTrue(50000 * line_length - 2 * parser.SEARCH_BLOCK_SIZE <= offset <= 50000 * line_length)
+
+    def test_should_include_lines_out_of_order_within_slack(self):
+        time_stamps = range(100000)
+        time_stamps[60000] = 50005
+        time_stamps[40000] = 50005
+        self.write(time_stamps)
+        parser = LogParser(self.file_name, time_from=50000, time_to=50010, slack=20000)
+
+        self.assertEqual(self.event_count(parser), 12)
+
+    def test_should_read_open_ended_range(self):
+        self.write(range(1000))
+
+        self.assertEqual(self.event_count(LogParser(self.file_name, time_from=990)), 10)
+        self.assertEqual(self.event_count(LogParser(self.file_name, time_to=10)), 10)
+
+    def test_should_align_buckets_to_start_of_range(self):
+        self.write(range(1000))
+        stats = LogParser(self.file_name, interval=10, time_from=995, time_to=1000).parse()
+
+        self.assertEqual([bucket.start_time for bucket in stats.buckets], [995])
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('1473448832.64'), 1473448832.64)
+        self.assertEqual(parse_time('2016-09-09 19:20:32'), parse_time('2016-09-09T19:20:32'))
+        self.assertAlmostEqual(parse_time('15m'), time.time() - 900, delta=5)
+        self.assertRaises(ValueError, parse_time, 'foo')
+
+
+class MultiIntervalLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        with open(self.file_name, 'w') as log_file:
+            for time_stamp in range(3, 7200, 7):
+                log_file.write('<|{}|test|{}|1|t|>\n'.format(time_stamp, time_stamp % 13))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assert_same_stats(self, stats, expected):
+        self.assertEqual(stats.interval, expected.interval)
+        self.assertEqual([bucket.start_time for bucket in stats.buckets],
+                         [bucket.start_time for bucket in expected.buckets])
+        for bucket, expected_bucket in zip(stats.buckets, expected.buckets):
+            timer_stats, expected_timer_stats = bucket.stats['test'], expected_bucket.stats['test']
+            self.assertEqual(timer_stats.event_count, expected_timer_stats.event_count)
+            self.assertAlmostEqual(timer_stats.total_time, expected_timer_stats.total_time)
+            self.assertEqual(timer_stats.percentile(90), expected_timer_stats.percentile(90))
+
+    def test_should_equal_separate_parses(self):
+        intervals = [60, 600, 3600, 90]
+
+        views = LogParser(self.file_name).parse_intervals(intervals)
+
+        self.assertEqual(len(views), 4)
+        for interval, stats in zip(intervals, views):
+            self.assert_same_stats(stats, LogParser(self.file_name, interval=interval).parse())
+
+
+class IndexedLogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'metrics.log')
+        self.write(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, count, mtime=1000000000):
+        with open(self.file_name, 'w') as log_file:
+            for time_stamp in range(0, 120, 5):
+                log_file.write('<|{}|test|{}|c|>\n'.format(time_stamp, count))
+                log_file.write('<|{}|other|{}|c|>\n'.format(time_stamp, count))
+        os.utime(self.file_name, (mtime, mtime))
+
+    def parse(self, **kwargs):
+        return LogParser(self.file_name, index_resolution=10, **kwargs).parse()
+
+    def event_counts(self, stats, tag='test'):
+        return [bucket.stats[tag].event_count for bucket in stats.buckets]
+
+    def test_should_write_index(self):
+        self.parse()
+
+        index = RollupIndex.load(self.file_name + RollupIndex.SUFFIX)
+        self.assertEqual(index.size, os.path.getsize(self.file_name))
+        self.assertEqual(index.aggregate_stats.interval, 10)
+        self.assertEqual(len(index.aggregate_stats.buckets), 12)
+
+    def test_should_restore_stats_from_index(self):
+        with open(self.file_name, 'a') as log_file:
+            log_file.write('<|0|caf\xc3\xa9|0.250000|2|t|>\n<|5|\xff|1.5|1.5|1.5|1.5|1|g|>\n')
+        self.parse()
+
+        index_stats = RollupIndex.load(self.file_name + RollupIndex.SUFFIX).aggregate_stats
+        self.assertEqual(index_stats.buckets[0].stats['caf\xc3\xa9'].percentile(50), 0.25)
+        self.assertEqual(index_stats.buckets[0].stats['\xff'].last, 1.5)
+        self.assertEqual(self.event_counts(index_stats), [2] * 12)
+
+    def test_should_report_stats_when_index_can_not_be_written(self):
+        # A directory in place of the index can neither be read nor replaced
+        os.mkdir(self.file_name + RollupIndex.SUFFIX)
+        stats = self.parse(interval=20, verbose=False)
+
+        self.assertEqual(self.event_counts(stats), [4] * 6)
+
+    def test_should_rebuild_unreadable_index(self):
+        for content in ['', '{"class": "os.system"}', '{"dict": [[1]]}', "cos\nsystem\n(S'true'\ntR."]:
+            with open(self.file_name + RollupIndex.SUFFIX, 'w') as index_file:
+                index_file.write(content)
+
+            self.assertEqual(RollupIndex.load(self.file_name + RollupIndex.SUFFIX), None)
+            self.assertEqual(self.event_counts(self.parse(interval=60)), [12, 12])
+
+    def test_should_report_coarser_interval_from_index(self):
+        self.parse()
+        self.write(2)
+
+        self.assertEqual(self.event_counts(self.parse(interval=60)), [12, 12])
+
+    def test_should_rebuild_index_when_file_changes(self):
+        self.parse()
+        self.write(2, mtime=1000000001)
+
+        self.assertEqual(self.event_counts(self.parse(interval=60)), [24, 24])
+
+    def test_should_filter_tags_from_index(self):
+        stats = self.parse(tag_filter=TagFilter(tags=['other']))
+
+        self.assertEqual(stats.buckets[0].stats.keys(), ['other'])
+
+    def test_should_parse_file_for_intervals_that_are_not_multiples(self):
+        self.assertEqual(self.event_counts(self.parse(interval=25)), [5, 5, 5, 5, 4])
+
+
+class TagFilterTest(unittest.TestCase):
+    def test_should_match_exact_tag(self):
+        tag_filter = TagFilter(tags=['db.query'])
+
+        self.assertTrue(tag_filter.matches_line('<|0|db.query|1|c|>'))
+        self.assertFalse(tag_filter.matches_line('<|0|db.query.slow|1|c|>'))
+        self.assertTrue(tag_filter.matches('db.query'))
+        self.assertFalse(tag_filter.matches('db.query.slow'))
+
+    def test_should_match_prefix(self):
+        tag_filter = TagFilter(prefixes=['http.checkout.', 'db.'])
+
+        self.assertTrue(tag_filter.matches_line('<|0|db.query|0.100000|1|t|>'))
+        self.assertTrue(tag_filter.matches_line('<|0|http.checkout.pay|1|c|>'))
+        self.assertFalse(tag_filter.matches_line('<|0|http.cart|1|c|>'))
+        self.assertTrue(tag_filter.matches('db.query'))
+
+    def test_should_match_regex_within_tag(self):
+        tag_filter = TagFilter(regex=r'.*\.slow$')
+
+        self.assertTrue(tag_filter.matches_line('<|0|db.query.slow|1|c|>'))
+        self.assertFalse(tag_filter.matches_line('<|0|db.query|0.100000|1|t|>'))
+        self.assertFalse(tag_filter.matches_line('<|0|db.query|1|c.slow|>'))
+        self.assertTrue(tag_filter.matches('db.query.slow'))
+
+    def test_should_match_anchored_regex_on_lines_and_tags(self):
+        tag_filter = TagFilter(regex=r'^db\.')
+
+        self.assertTrue(tag_filter.matches_line('<|0|db.query|1|c|>'))
+        self.assertFalse(tag_filter.matches_line('<|0|http.db.query|1|c|>'))
+        self.assertTrue(tag_filter.matches('db.query'))
+        self.assertFalse(tag_filter.matches('http.db.query'))
+
+    def test_should_filter_text_and_binary_logs(self):
+        dir = tempfile.mkdtemp()
+        try:
+            text_file = os.path.join(dir, 'metrics.log')
+            with open(text_file, 'w') as log_file:
+                log_file.write('<|0|db.query|1|c|>\n<|0|http.cart|2|c|>\n')
+            binary_file = os.path.join(dir, 'metrics.bin')
+            logger = BinaryMetricLogger(binary_file)
+            counter = Counter(logger, MockClock(0))
+            counter.incr('db.query', 4)
+            counter.incr('http.cart', 8)
+            logger.close()
+
+            for file_name in [text_file, binary_file]:
+                stats = LogParser(file_name, tag_filter=TagFilter(prefixes=['db.'])).parse()
+                self.assertEqual(stats.buckets[0].stats.keys(), ['db.query'])
+        finally:
+            shutil.rmtree(dir)
+
+    def test_should_align_buckets_to_first_event_on_every_path(self):
+        dir = tempfile.mkdtemp()
+        try:
+            text_file = os.path.join(dir, 'metrics.log')
+            with open(text_file, 'w') as log_file:
+                log_file.write('<|3|http.cart|1|c|>\n')
+                for time_stamp in range(5, 100, 10):
+                    log_file.write('<|{}|db.query|1|c|>\n'.format(time_stamp))
+            compact_file = os.path.join(dir, 'metrics.compact')
+            binary_file = os.path.join(dir, 'metrics.bin')
+            for logger in [CompactFileMetricLogger(compact_file, base_interval=20), BinaryMetricLogger(binary_file)]:
+                clock = MockClock(3)
+                Counter(logger, clock).incr('http.cart')
+                for time_stamp in range(5, 100, 10):
+                    clock.set(time_stamp)
+                    Counter(logger, clock).incr('db.query')
+                logger.close()
+
+            tag_filter = TagFilter(prefixes=['db.'])
+            for file_name in [text_file, compact_file, binary_file]:
+                results = []
+                for options in [{}, {'jobs': 2}, {'index_resolution': 1}]:
+                    stats = LogParser(file_name, interval=20, tag_filter=tag_filter, **options).parse()
+                    results.append([(bucket.start_time, bucket.stats['db.query'].event_count)
+                                    for bucket in stats.buckets])
+                self.assertEqual(results[0], [(3, 2), (23, 2), (43, 2), (63, 2), (83, 2)])
+                self.assertEqual(results[1], results[0])
+                self.assertEqual(results[2], results[0])
+        finally:
+            shutil.rmtree(dir)
+
+
+class MaxTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = AggregateStats(60, max_tags=10)
+
+    def add_lines(self, stats, time_stamp=0):
+        # One heavy tag interleaved with many tags seen once
+        for i in range(200):
+            stats.parse_line('<|{}|hot|1|c|>'.format(time_stamp))
+            stats.parse_line('<|{}|tag.{}|1|c|>'.format(time_stamp, i))
+
+    def test_should_keep_heavy_hitters_within_cap(self):
+        self.add_lines(self.stats)
+
+        bucket = self.stats.buckets[0]
+        self.assertEqual(len(bucket.stats), 11)
+        self.assertIn('hot', bucket.stats)
+        self.assertGreaterEqual(bucket.stats['hot'].event_count + bucket.error('hot'), 200)
+        self.assertEqual(sum(tag_stats.event_count for tag_stats in bucket.stats.values()), 400)
+
+    def test_should_fold_other_tags_per_type(self):
+        stats = AggregateStats(60, max_tags=1)
+        stats.parse_line('<|0|a|1|c|>')
+        stats.parse_line('<|0|b|1.000000|1|t|>')
+        stats.parse_line('<|0|c|2|c|>')
+
+        others = sorted((tag_stats.type, tag_stats.event_count) for tag_stats in stats.buckets[0].stats.values()
+                        if tag_stats.tag == '__other__')
+        self.assertEqual(others, [('c', 1), ('t', 1)])
+        self.assertEqual(stats.max_tag_len(), len('__other__'))
+
+    def test_merge_should_keep_cap(self):
+        other = AggregateStats(60, origin=0, max_tags=10)
+        self.stats = AggregateStats(60, origin=0, max_tags=10)
+        self.add_lines(self.stats)
+        self.add_lines(other)
+
+        self.stats.merge(other)
+
+        bucket = self.stats.buckets[0]
+        self.assertEqual(len(bucket.stats), 11)
+        self.assertGreaterEqual(bucket.stats['hot'].event_count + bucket.error('hot'), 400)
+        self.assertEqual(sum(tag_stats.event_count for tag_stats in bucket.stats.values()), 800)
+
+    def test_rollup_should_keep_cap(self):
+        self.stats = AggregateStats(10, max_tags=10)
+        self.add_lines(self.stats, 0)
+        self.add_lines(self.stats, 10)
+
+        bucket = self.stats.rollup(60).buckets[0]
+        self.assertEqual(len(bucket.stats), 11)
+        self.assertEqual(sum(tag_stats.event_count for tag_stats in bucket.stats.values()), 800)
+
+    def test_should_reject_cap_below_one(self):
+        self.assertRaises(ValueError, AggregateStats, 60, max_tags=0)
+        self.assertRaises(argparse.ArgumentTypeError, positive_int, '0')
+        self.assertEqual(positive_int('3'), 3)
+
+    def test_parser_should_cap_tags(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, 'metrics.log')
+            with open(file_name, 'w') as log_file:
+                for i in range(100):
+                    log_file.write('<|{}|hot|1|c|>\n<|{}|tag.{}|1|c|>\n'.format(i, i, i))
+
+            bucket = LogParser(file_name, max_tags=5, jobs=2).parse().buckets[0]
+            self.assertIn('hot', bucket.stats)
+            self.assertLessEqual(len(bucket.stats), 6)
+        finally:
+            shutil.rmtree(directory)
+
+
+class SpanOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = AggregateStats(60)
+        for line in ['<|0|http.request|0.5|1|t|>',
+                     '<|0|http.request;db.query|0.2|1|t|>',
+                     '<|0|http.request;db.query;connect|0.05|1|t|>',
+                     '<|0|http.request;render|0.1|1|t|>',
+                     '<|0|http.request|0.3|1|t|>',
+                     '<|0|http.request;db.query|0.1|1|t|>',
+                     '<|0|http.requests|3|c|>']:
+            self.stats.parse_line(line)
+
+    def test_should_subtract_child_spans_from_exclusive_time(self):
+        times = [(stats.tag, stats.event_count, round(stats.total_time, 6), round(exclusive_time, 6))
+                 for stats, exclusive_time in span_times(self.stats.buckets[0])]
+
+        self.assertEqual(times, [('http.request', 2, 0.8, 0.4),
+                                 ('http.request;db.query', 2, 0.3, 0.25),
+                                 ('http.request;db.query;connect', 1, 0.05, 0.05),
+                                 ('http.request;render', 1, 0.1, 0.1)])
+
+    def test_should_print_collapsed_stacks_in_microseconds(self):
+        stdout = sys.stdout
+        sys.stdout = output = StringIO.StringIO()
+        try:
+            CollapsedOutput(self.stats).bucket_footer(self.stats.buckets[0])
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(output.getvalue().splitlines(), ['http.request 400000',
+                                                          'http.request;db.query 250000',
+                                                          'http.request;db.query;connect 50000',
+                                                          'http.request;render 100000'])
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def setUp(self):
+        self.sketch = QuantileSketch(relative_accuracy=0.01)
+
+    def assert_within_accuracy(self, estimate, expected):
+        self.assertTrue(abs(estimate - expected) <= 0.01 * expected, '{} != {}'.format(estimate, expected))
+
+    def test_quantiles_should_be_within_relative_accuracy(self):
+        for value in range(1, 1001):
+            self.sketch.add(value / 1000.0)
+
+        self.assert_within_accuracy(self.sketch.quantile(0.5), 0.5)
+        self.assert_within_accuracy(self.sketch.quantile(0.9), 0.9)
+        self.assert_within_accuracy(self.sketch.quantile(0.99), 0.99)
+
+    def test_should_weight_values_by_count(self):
+        self.sketch.add(1.0, 9)
+        self.sketch.add(100.0)
+
+        self.assert_within_accuracy(self.sketch.quantile(0.5), 1.0)
+        self.assert_within_accuracy(self.sketch.quantile(1), 100.0)
+
+    def test_merge_should_equal_single_sketch(self):
+        other = QuantileSketch(relative_accuracy=0.01)
+        merged = QuantileSketch(relative_accuracy=0.01)
+        for value in range(1, 1001):
+            (self.sketch if value % 2 else other).add(value / 1000.0)
+            merged.add(value / 1000.0)
+
+        self.sketch.merge(other)
+
+        self.assertEqual(self.sketch.bins, merged.bins)
+        self.assertEqual(self.sketch.count, merged.count)
+
+    def test_merge_should_require_same_accuracy(self):
+        self.assertRaises(ValueError, self.sketch.merge, QuantileSketch(relative_accuracy=0.05))
+
+    def test_bins_should_be_bounded(self):
+        sketch = QuantileSketch(max_bins=10)
+        for exponent in range(-50, 50):
+            sketch.add(1.5 ** exponent)
+
+        self.assertEqual(len(sketch.bins), 10)
+        self.assertEqual(sketch.count, 100)
+        self.assert_within_accuracy(sketch.quantile(1), 1.5 ** 49)
+
+    def test_empty_sketch_should_return_zero(self):
+        self.assertEqual(self.sketch.quantile(0.5), 0.0)
+
+
+class AggregateStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = AggregateStats(60)
+
+    def test_should_read_timer_rollup(self):
+        self.stats.parse_line('<|0|test|3.000000|2|1.000000|2.000000|t|>')
+
+        timer_stats = self.stats.buckets[0].stats['test']
+        self.assertEqual(timer_stats.event_count, 2)
+        self.assertEqual(timer_stats.total_time, 3.0)
+        self.assertEqual(timer_stats.min_time, 1.0)
+        self.assertEqual(timer_stats.max_time, 2.0)
+
+    def test_should_bucket_out_of_order_lines(self):
+        self.stats = AggregateStats(10)
+        for time_stamp in [5, 25, 7, 15, 0, 24, 6]:
+            self.stats.parse_line('<|{}|test|1|c|>'.format(time_stamp))
+
+        self.assertEqual([bucket.start_time for bucket in self.stats.buckets], [-5, 5, 15, 25])
+        self.assertEqual([bucket.stats['test'].event_count for bucket in self.stats.buckets], [1, 3, 2, 1])
+
+    def test_max_tag_len(self):
+        self.assertEqual(self.stats.max_tag_len(), 0)
+        self.stats.parse_line('<|0|test|1|c|>')
+        self.stats.parse_line('<|120|test.long|1|c|>')
+
+        self.assertEqual(self.stats.max_tag_len(), 9)
+
+    def test_merge_should_require_same_origin(self):
+        other = AggregateStats(60, origin=1)
+        other.parse_line('<|0|test|1|c|>')
+        self.stats.parse_line('<|0|test|1|c|>')
+
+        self.assertRaises(ValueError, self.stats.merge, other)
+
+    def test_merge_should_combine_buckets_with_same_start_time(self):
+        self.stats = AggregateStats(10, origin=0)
+        other = AggregateStats(10, origin=0)
+        self.stats.parse_line('<|5|test|1.000000|1|t|>')
+        other.parse_line('<|6|test|3.000000|2|t|>')
+        other.parse_line('<|7|test.count|4|c|>')
+        other.parse_line('<|25|test.count|4|c|>')
+
+        self.stats.merge(other)
+
+        self.assertEqual([bucket.start_time for bucket in self.stats.buckets], [0, 20])
+        timer_stats = self.stats.buckets[0].stats['test']
+        self.assertEqual(timer_stats.event_count, 3)
+        self.assertEqual(timer_stats.total_time, 4.0)
+        self.assertEqual(timer_stats.min_time, 1.0)
+        self.assertEqual(timer_stats.max_time, 3.0)
+
+    def test_merge_should_not_share_stats_with_merged_buckets(self):
+        other = AggregateStats(60)
+        other.parse_line('<|0|test|4|c|>')
+
+        self.stats.merge(other)
+        self.stats.merge(other)
+
+        self.assertEqual(self.stats.buckets[0].stats['test'].event_count, 8)
+        self.assertEqual(other.buckets[0].stats['test'].event_count, 4)
+
+    def test_timer_percentiles(self):
+        for elapsed_time in range(1, 101):
+            self.stats.parse_line('<|0|test|{}|1|t|>'.format(elapsed_time))
+
+        timer_stats = self.stats.buckets[0].stats['test']
+        self.assertAlmostEqual(timer_stats.percentile(50), 50, delta=0.5)
+        self.assertAlmostEqual(timer_stats.percentile(99), 99, delta=1)
+        self.assertEqual(timer_stats.percentile(100), 100)
+
+    def test_timer_percentiles_should_be_within_min_and_max(self):
+        self.stats.parse_line('<|0|test|123456.987|1|t|>')
+
+        self.assertEqual(self.stats.buckets[0].stats['test'].percentile(50), 123456.987)
+
+    def test_rollup_should_merge_buckets(self):
+        self.stats = AggregateStats(10)
+        for time_stamp in range(0, 60, 5):
+            self.stats.parse_line('<|{}|test|{}|1|t|>'.format(time_stamp, time_stamp))
+
+        rollup = self.stats.rollup(30)
+
+        self.assertEqual(rollup.interval, 30)
+        self.assertEqual([bucket.start_time for bucket in rollup.buckets], [0, 30])
+        self.assertEqual([bucket.stats['test'].event_count for bucket in rollup.buckets], [6, 6])
+        self.assertEqual([bucket.stats['test'].total_time for bucket in rollup.buckets], [75, 255])
+        self.assertEqual([bucket.stats['test'].max_time for bucket in rollup.buckets], [25, 55])
+
+    def test_rollup_should_require_multiple_of_interval(self):
+        self.assertRaises(ValueError, self.stats.rollup, 90)
+
+    def test_should_combine_timer_rollup_with_raw_lines(self):
+        self.stats.parse_line('<|0|test|3.000000|2|1.000000|2.000000|t|>')
+        self.stats.parse_line('<|1|test|0.500000|1|t|>')
+
+        timer_stats = self.stats.buckets[0].stats['test']
+        self.assertEqual(timer_stats.event_count, 3)
+        self.assertEqual(timer_stats.total_time, 3.5)
+        self.assertEqual(timer_stats.min_time, 0.5)
+        self.assertEqual(timer_stats.max_time, 2.0)
+
+
 if __name__ == '__main__':
     suite = unittest.TestSuite()
-    for test_class in [TimerTest, CounterTest]:
+    for test_class in [TimerTest, TimedTest, SpanTest, CountedTest, CounterTest, GaugeTest, AggregatingMetricLoggerTest,
+                       ThreadLocalAggregatingMetricLoggerTest, AdaptiveSamplingMetricLoggerTest,
+                       LiveStatsMetricLoggerTest,
+                       AsyncFileMetricLoggerTest, BinaryMetricLoggerTest, ShardedFileMetricLoggerTest, CollectorTest,
+                       CompactFileMetricLoggerTest, BlockFileMetricLoggerTest,
+                       ParallelLogParserTest,
+                       IncrementalLogParserTest, MergedLogParserTest,
+                       TimeRangeLogParserTest, MultiIntervalLogParserTest,
+                       IndexedLogParserTest,
+                       TagFilterTest, MaxTagsTest, SpanOutputTest, QuantileSketchTest, AggregateStatsTest]:
         tests = unittest.TestLoader().loadTestsFromTestCase(test_class)
         suite.addTests(tests)
     unittest.TextTestRunner(verbosity=2).run(suite)